@@ -0,0 +1,365 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+import os
+import sys
+import io
+import re
+import glob
+import json
+import time
+import hashlib
+import shutil
+import logging
+import datetime
+import platform
+import tempfile
+import threading
+import subprocess
+import http.server
+from concurrent.futures import ThreadPoolExecutor
+import bs4
+import tugua
+
+
+def load_sources(src_dir, limit=0):
+	'''\
+	Load the latest [limit:int] saved source pages under [src_dir:str], all of them if [limit] is 0, either raw or compressed.
+	Return: list((str, bytes)) - date string and page data
+	'''
+	pages = []
+	names = glob.glob(os.path.join(src_dir, "[0-9]" * 8 + ".html")) + glob.glob(os.path.join(src_dir, "[0-9]" * 8 + ".html.gz"))
+	dates = sorted(set(os.path.basename(name)[:8] for name in names))
+	if limit:
+		dates = dates[-limit:]
+	for date_str in dates:
+		pages.append((date_str, tugua.read_source(tugua.get_source_path(os.path.join(src_dir, date_str + ".html")))))
+	return pages
+
+def corpus_record(directory, corpus_dir, limit=0):
+	'''\
+	Record the latest [limit:int] stored pages under tugua [directory:str] into [corpus_dir:str], with the catalogue and their images.
+	Images are taken from the image cache, or from the date folders by the journal manifest, and a page is complete only if all its images are found.
+	Return: dict - corpus index, also stored as "index.json"
+	'''
+	directory = os.path.realpath(os.path.abspath(directory))
+	src_dir = os.path.join(directory, tugua.config["TUGUA"]["SrcDir"])
+	img_cache = tugua.get_imgcache(directory)
+	journal = tugua.get_journal(src_dir)
+	for sub_dir in ("pages", "images"):
+		if not os.path.isdir(os.path.join(corpus_dir, sub_dir)):
+			os.makedirs(os.path.join(corpus_dir, sub_dir))
+	def add_file(name, data):
+		with open(os.path.join(corpus_dir, name), "wb") as corpus_file:
+			corpus_file.write(data)
+		return name
+	index = {"catalog": None, "pages": [], "images": {}}
+	catalog_path = tugua.get_source_path(os.path.join(directory, tugua.config["TUGUA"]["CatalogFile"]))
+	if os.path.isfile(catalog_path):
+		catalog_url = tugua.load_validator(catalog_path).get("url") or tugua.config["TUGUA"]["CatalogURL"]
+		index["catalog"] = {"url": tugua.get_absolute_url(catalog_url), "file": add_file("catalog.html", tugua.read_source(catalog_path))}
+	for (date_str, data) in load_sources(src_dir, limit):
+		page_url = tugua.load_validator(tugua.get_source_path(os.path.join(src_dir, date_str + ".html"))).get("url")
+		if not page_url:
+			print("Skip page '{}': no url stored.".format(date_str))
+			continue
+		page = {"date": date_str, "url": tugua.get_absolute_url(page_url), "file": add_file("pages/{}.html".format(date_str), data), "complete": True}
+		index["pages"].append(page)
+		try:
+			(prologue, sections) = tugua.tugua_split(tugua.parse_html(data), tugua.BeautifulSoup("", tugua.get_html_parser()), base_url=page_url)
+		except Exception as e:
+			print("Skip images of page '{}': {}".format(date_str, repr(e)))
+			page["complete"] = False
+			continue
+		manifest = {url.strip(): name for (url, (name, _)) in journal.manifest(date_str).items()}
+		for section in [prologue] + sections:
+			for tag in section.find_all("img"):
+				url = tag["src"].strip()
+				key = tugua.get_absolute_url(url)
+				if url.startswith("data:") or url.startswith("file:") or key in index["images"]:
+					continue
+				path = img_cache.find(url) if img_cache else None
+				if not path and manifest.get(url):
+					path = os.path.join(directory, date_str, manifest[url])
+				if not path or not os.path.isfile(path):
+					page["complete"] = False
+					continue
+				with open(path, "rb") as img_file:
+					img_data = img_file.read()
+				index["images"][key] = add_file("images/" + hashlib.sha1(img_data).hexdigest(), img_data)
+	with open(os.path.join(corpus_dir, "index.json"), "w", encoding="UTF-8") as index_file:
+		json.dump(index, index_file, indent=1)
+	return index
+
+def corpus_load(corpus_dir):
+	'''\
+	Load corpus index recorded in [corpus_dir:str] by "corpus_record".
+	Return: dict
+	'''
+	with open(os.path.join(corpus_dir, "index.json"), "r", encoding="UTF-8") as index_file:
+		return json.load(index_file)
+
+class CorpusServer(object):
+	'''\
+	Local stand-in HTTP server for a recorded corpus, answering recorded urls with keep-alive and 404 for anything else.
+	While started, its [runtime:tugua.Runtime] routes all http and https urls to it by url switch rules, to be passed to tugua functions.
+	'''
+	def __init__(self, corpus_dir, index):
+		self.corpus_dir = corpus_dir
+		self.files = dict(index["images"])
+		for page in index["pages"]:
+			self.files[page["url"]] = page["file"]
+		if index["catalog"]:
+			self.files[index["catalog"]["url"]] = index["catalog"]["file"]
+		self.httpd = None
+		self.prefix = None
+		self.runtime = None
+
+	def start(self):
+		server = self
+		class Handler(http.server.BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+			def do_GET(self):
+				url = server.prefix + self.path
+				for scheme in ("https", "http"):
+					url = url.replace("{}/{}/".format(server.prefix, scheme), scheme + "://")
+				data = b""
+				if url in server.files:
+					with open(os.path.join(server.corpus_dir, server.files[url]), "rb") as corpus_file:
+						data = corpus_file.read()
+				self.send_response(200 if url in server.files else 404)
+				self.send_header("Content-Length", str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+			def log_message(self, format, *args):
+				pass
+		self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+		self.httpd.daemon_threads = True
+		self.prefix = "http://127.0.0.1:{}".format(self.httpd.server_address[1])
+		threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+		url_switch = {"https://": self.prefix + "/https/", "http://": self.prefix + "/http/"}
+		self.runtime = tugua.get_runtime()._replace(url_switch=url_switch, url_switch_regex=re.compile("https://|http://"))
+
+	def stop(self):
+		self.runtime = None
+		tugua.close_connpool()
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+def bench_parse(pages, repeat=1):
+	'''\
+	Time encoding detection and "tugua.parse_html" on [pages:list((str, bytes))] for [repeat:int] times, with every installed parser.
+	Return: dict(str:float) - seconds per page of each step
+	'''
+	result = {}
+	start = time.perf_counter()
+	for _ in range(repeat):
+		for (_, data) in pages:
+			tugua.sniff_encoding(data)
+	result["sniff"] = (time.perf_counter() - start) / repeat / len(pages)
+	parser_conf = tugua.config["TUGUA"]["HtmlParser"]
+	for parser in ("html.parser", "lxml"):
+		tugua.config["TUGUA"]["HtmlParser"] = parser
+		tugua.htmlparser = None
+		if tugua.get_html_parser() != parser:
+			continue
+		start = time.perf_counter()
+		for _ in range(repeat):
+			for (_, data) in pages:
+				tugua.parse_html(data)
+		result["parse:" + parser] = (time.perf_counter() - start) / repeat / len(pages)
+	tugua.config["TUGUA"]["HtmlParser"] = parser_conf
+	tugua.htmlparser = None
+	return result
+
+def bench_convert(pages, repeat=1, runtime=None):
+	'''\
+	Time each conversion step on [pages:list((str, bytes))] for [repeat:int] times with the configured parser and [runtime:tugua.Runtime], pages failed to analyze are skipped.
+	Steps are "tugua.parse_html", "tugua.tugua_split" which runs "tugua.tugua_analyze", "tugua.tugua_format" without images, and "tugua.write_html" in both forms.
+	Return: dict(str:float) - seconds per page of each step
+	'''
+	spent = dict.fromkeys(("parse", "analyze", "format", "serialize:pretty", "serialize:compact"), 0.0)
+	count = 0
+	for (date_str, data) in pages:
+		for _ in range(repeat):
+			timer = time.perf_counter()
+			src = tugua.parse_html(data)
+			dest = tugua.BeautifulSoup("", tugua.get_html_parser())
+			spent["parse"] += time.perf_counter() - timer
+			timer = time.perf_counter()
+			try:
+				(prologue, sections) = tugua.tugua_split(src, dest, runtime=runtime)
+			except Exception as e:
+				print("Skip page '{}': {}".format(date_str, repr(e)))
+				break
+			spent["analyze"] += time.perf_counter() - timer
+			timer = time.perf_counter()
+			dest.append(dest.new_tag("html"))
+			dest.html.append(dest.new_tag("body"))
+			dest.html.body.append(tugua.tugua_format(prologue, dest, down_img=False, runtime=runtime))
+			for index in range(len(sections)):
+				dest.html.body.append(tugua.tugua_format(sections[index], dest, section_id="{:02}".format(index+1), has_subtitle=True, down_img=False, runtime=runtime))
+			spent["format"] += time.perf_counter() - timer
+			for pretty in (True, False):
+				timer = time.perf_counter()
+				tugua.write_html(dest, io.StringIO(), pretty)
+				spent["serialize:pretty" if pretty else "serialize:compact"] += time.perf_counter() - timer
+			count += 1
+	if not count:
+		return {}
+	return {step: seconds / count for (step, seconds) in spent.items()}
+
+def bench_download(urls, repeat=1, runtime=None):
+	'''\
+	Time "tugua.down_url" on image [urls:list(str)] for [repeat:int] times with [runtime:tugua.Runtime], by "ThreadCount" threads like "tugua.tugua_images".
+	Return: dict(str:float) - seconds per image and throughput in MB/s
+	'''
+	if not urls:
+		return {}
+	runtime = runtime or tugua.get_runtime()
+	size = 0
+	failed = 0
+	start = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=runtime.thread_count) as executor:
+		for _ in range(repeat):
+			for data in executor.map(lambda url: tugua.down_url(url, None, referer="", runtime=runtime), urls):
+				if data:
+					size += len(data)
+				else:
+					failed += 1
+	seconds = time.perf_counter() - start
+	if failed:
+		print("{} of {} image downloads failed.".format(failed, len(urls) * repeat))
+	return {"download": seconds / repeat / len(urls), "download:mbps": size / seconds / (1 << 20)}
+
+def bench_pipeline(corpus_dir, index, repeat=1, runtime=None):
+	'''\
+	Time the whole "tugua.catalogue_analyze" with [runtime:tugua.Runtime] on the recorded catalogue of [index:dict] in [corpus_dir:str] for [repeat:int] times, each into a new temporary directory.
+	Dates not recorded completely are marked done beforehand, so that only complete pages are converted, and it never waits for input.
+	Return: dict(str:float) - seconds per page
+	'''
+	complete = set(page["date"] for page in index["pages"] if page["complete"])
+	if not index["catalog"] or not complete:
+		return {}
+	with open(os.path.join(corpus_dir, index["catalog"]["file"]), "rb") as catalog_file:
+		listed = set(re.findall(r"【喷嚏图卦(\d{8})】", tugua.parse_html(catalog_file.read()).get_text()))
+	(conf, log_conf) = (tugua.config["TUGUA"], tugua.config["LOG"])
+	saved = (conf["MinDate"], conf["ImgCacheDir"], log_conf["MetricsFile"], sys.stdin)
+	(conf["MinDate"], conf["ImgCacheDir"], log_conf["MetricsFile"], sys.stdin) = ("", "", "", io.StringIO())
+	seconds = 0.0
+	count = 0
+	try:
+		for _ in range(repeat):
+			directory = tempfile.mkdtemp(prefix="tugua_bench_")
+			try:
+				for date_str in listed - complete:
+					os.makedirs(os.path.join(directory, date_str))
+					open(os.path.join(directory, date_str, conf["DestFile"]), "wb").close()
+				start = time.perf_counter()
+				count += tugua.catalogue_analyze(index["catalog"]["url"], directory, runtime=runtime)
+				seconds += time.perf_counter() - start
+			finally:
+				tugua.close_journal()
+				shutil.rmtree(directory, ignore_errors=True)
+	finally:
+		(conf["MinDate"], conf["ImgCacheDir"], log_conf["MetricsFile"], sys.stdin) = saved
+	if not count:
+		return {}
+	return {"pipeline": seconds / count}
+
+def get_commit():
+	'''\
+	Get the git commit of this script, with "+" appended if there are local changes.
+	Return: str - None if not in a git repository
+	'''
+	try:
+		commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=tugua.get_py_path(), capture_output=True, text=True, check=True).stdout.strip()
+		status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=tugua.get_py_path(), capture_output=True, text=True, check=True).stdout
+	except (OSError, subprocess.CalledProcessError):
+		return None
+	return commit + ("+" if status.strip() else "")
+
+def bench_run(corpus_dir, repeat=1):
+	'''\
+	Run all benchmarks on the corpus in [corpus_dir:str] for [repeat:int] times, downloading from a "CorpusServer".
+	Return: dict - environment, and seconds of each step in "steps"
+	'''
+	index = corpus_load(corpus_dir)
+	pages = []
+	for page in index["pages"]:
+		with open(os.path.join(corpus_dir, page["file"]), "rb") as page_file:
+			pages.append((page["date"], page_file.read()))
+	result = {
+		"time": datetime.datetime.now().isoformat(timespec="seconds"),
+		"commit": get_commit(),
+		"python": platform.python_version(),
+		"bs4": bs4.__version__,
+		"parser": tugua.get_html_parser(),
+		"pages": len(pages),
+		"images": len(index["images"]),
+		"repeat": repeat,
+		"steps": {},
+	}
+	if pages:
+		result["steps"].update(bench_parse(pages, repeat))
+		result["steps"].update(bench_convert(pages, repeat, tugua.get_runtime()))
+	server = CorpusServer(corpus_dir, index)
+	server.start()
+	try:
+		result["steps"].update(bench_download(list(index["images"]), repeat, server.runtime))
+		result["steps"].update(bench_pipeline(corpus_dir, index, repeat, server.runtime))
+	finally:
+		server.stop()
+	return result
+
+def bench_compare(base, result):
+	'''\
+	Print steps of benchmark [result:dict] against [base:dict], both from "bench_run".
+	Return: None
+	'''
+	print("{:<20} {:>12} {:>12} {:>8}".format("step", (base["commit"] or "base")[:12], (result["commit"] or "new")[:12], "change"))
+	for step in sorted(set(base["steps"]) | set(result["steps"])):
+		(old, new) = (base["steps"].get(step), result["steps"].get(step))
+		change = "{:+.1%}".format(new / old - 1) if old and new else ""
+		print("{:<20} {:>12} {:>12} {:>8}".format(step, "{:.6g}".format(old) if old else "-", "{:.6g}".format(new) if new else "-", change))
+
+
+if __name__ == "__main__":
+	os.chdir(tugua.get_py_path())
+	tugua.init_config("tugua.cfg")
+	tugua.init_logger(level=logging.ERROR)
+	directory = tugua.config["TUGUA"]["TuguaDir"]
+	corpus_dir = os.path.join(directory, "benchmark")
+	usage = "Usage: {0} record [page_count]\n       {0} run [repeat_count] [result_file]\n       {0} compare base_file result_file".format(sys.argv[0])
+	if len(sys.argv) < 2 or sys.argv[1] not in ("record", "run", "compare"):
+		print(usage)
+		exit(1)
+	if sys.argv[1] == "record":
+		index = corpus_record(directory, corpus_dir, int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+		tugua.close_journal()
+		complete = len([page for page in index["pages"] if page["complete"]])
+		print("Recorded {} pages ({} complete) and {} images into '{}'.".format(len(index["pages"]), complete, len(index["images"]), corpus_dir))
+	elif sys.argv[1] == "run":
+		if not os.path.isfile(os.path.join(corpus_dir, "index.json")):
+			print("No corpus found in '{}', record it first.".format(corpus_dir))
+			exit(1)
+		repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+		result = bench_run(corpus_dir, repeat)
+		result_path = sys.argv[3] if len(sys.argv) > 3 else os.path.join(corpus_dir, "results", "{}_{}.json".format(datetime.datetime.now().strftime("%Y%m%d_%H%M%S"), (result["commit"] or "unknown")[:8]))
+		if os.path.dirname(result_path) and not os.path.isdir(os.path.dirname(result_path)):
+			os.makedirs(os.path.dirname(result_path))
+		with open(result_path, "w", encoding="UTF-8") as result_file:
+			json.dump(result, result_file, indent=1)
+		print("Benchmark on {} pages and {} images, {} times.".format(result["pages"], result["images"], repeat))
+		for (step, value) in result["steps"].items():
+			if step.endswith(":mbps"):
+				print("{:<20} {:>10.2f} MB/s".format(step, value))
+			else:
+				print("{:<20} {:>10.2f} ms".format(step, value * 1000))
+		print("Result saved into '{}'.".format(result_path))
+	else:
+		if len(sys.argv) != 4:
+			print(usage)
+			exit(1)
+		with open(sys.argv[2], "r", encoding="UTF-8") as base_file, open(sys.argv[3], "r", encoding="UTF-8") as result_file:
+			bench_compare(json.load(base_file), json.load(result_file))
@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+import os
+import io
+import re
+import socket
+import tempfile
+import threading
+import logging
+import unittest
+import http.server
+from PIL import Image
+import tugua
+
+
+class CutServer(object):
+	'''\
+	Local HTTP server cutting off the body of each full response after "cut" bytes, while answering "Range" requests in whole.
+	Paths starting with "/always" are cut off every time, ignoring "Range".
+	'''
+	cut = 70000
+
+	def __init__(self, files):
+		self.files = files
+		self.ranges = []
+		server = self
+		class Handler(http.server.BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+
+			def do_GET(self):
+				data = server.files[self.path.split("?")[0]]
+				range_match = re.match(r"^bytes=(\d+)-$", self.headers.get("Range", ""))
+				start = int(range_match.group(1)) if range_match and not self.path.startswith("/always") else 0
+				server.ranges.append(start)
+				if start:
+					self.send_response(206)
+					self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(data) - 1, len(data)))
+				else:
+					self.send_response(200)
+				self.send_header("ETag", "\"test\"")
+				self.send_header("Content-Length", str(len(data) - start))
+				self.end_headers()
+				if start:
+					self.wfile.write(data[start:])
+					return
+				self.wfile.write(data[:server.cut])
+				self.wfile.flush()
+				self.close_connection = True
+				self.connection.shutdown(socket.SHUT_RDWR)
+
+			def log_message(self, format, *args):
+				pass
+		self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+
+	def url(self, path):
+		return "http://127.0.0.1:{}{}".format(self.server.server_address[1], path)
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+
+class DownloadTest(unittest.TestCase):
+	@classmethod
+	def setUpClass(cls):
+		tugua.init_config(os.path.join(os.path.dirname(os.path.abspath(__file__)), "tugua.cfg"))
+		if tugua.logger is None:
+			tugua.init_logger(level=logging.CRITICAL)
+		cls.runtime = tugua.get_runtime()._replace(url_switch={}, url_switch_regex=None, retry_backoff=0.01)
+		img = io.BytesIO()
+		Image.frombytes("RGB", (400, 300), os.urandom(400 * 300 * 3)).save(img, "PNG")
+		cls.data = bytes(range(256)) * 800
+		cls.img = img.getvalue()
+		cls.server = CutServer({"/data": cls.data, "/always": cls.data, "/img.png": cls.img})
+		cls.tmp_dir = tempfile.TemporaryDirectory()
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.stop()
+		tugua.close_connpool()
+		cls.tmp_dir.cleanup()
+
+	def test_memory_resumed(self):
+		self.server.ranges.clear()
+		self.assertEqual(tugua.down_url(self.server.url("/data"), None, runtime=self.runtime), self.data)
+		self.assertEqual(self.server.ranges, [0, CutServer.cut])
+
+	def test_file_resumed(self):
+		path = os.path.join(self.tmp_dir.name, "data.bin")
+		self.assertTrue(tugua.down_url(self.server.url("/data"), path, override=True, runtime=self.runtime))
+		with open(path, "rb") as data_file:
+			self.assertEqual(data_file.read(), self.data)
+		self.assertFalse(os.path.exists(path + ".part"))
+
+	def test_file_truncated(self):
+		path = os.path.join(self.tmp_dir.name, "always.bin")
+		self.assertFalse(tugua.down_url(self.server.url("/always"), path, override=True, runtime=self.runtime))
+		self.assertFalse(os.path.exists(path))
+		self.assertFalse(os.path.exists(path + ".part"))
+
+	def test_image_streamed(self):
+		(sniffer, tmp_path) = tugua.down_img(self.server.url("/img.png"), self.tmp_dir.name, runtime=self.runtime)
+		self.assertEqual((sniffer.format, sniffer.size), ("png", (400, 300)))
+		self.assertEqual(os.path.dirname(tmp_path), self.tmp_dir.name)
+		with open(tmp_path, "rb") as img_file:
+			self.assertEqual(img_file.read(), self.img)
+		os.remove(tmp_path)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -4,14 +4,41 @@
 import os
 import sys
 import datetime
+import time
+import random
 import re
 import logging
 import pickle
+import sqlite3
+import json
+import hashlib
+import gzip
+import base64
+import shutil
+import zipfile
+import mmap
+import struct
+import mimetypes
 import urllib.request
 import urllib.parse
 import socket
+import ssl
+import threading
+import signal
+import contextlib
+import codecs
+import io
+import typing
+import multiprocessing
+import http.server
 from http import client
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import Future
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
 from bs4 import BeautifulSoup
+from bs4 import FeatureNotFound
 from bs4.element import Tag
 from bs4.element import NavigableString
 from bs4.element import Comment
@@ -21,9 +48,18 @@ from PIL import Image
 
 # global variables
 config = None
+config_path = None
+runtime = None
 logger = None
-urlsrc = None
-urlswitch = None
+connpool = None
+downlimit = None
+hostlimit = None
+imgcache = None
+transcoder = None
+journal = None
+htmlparser = None
+global_lock = threading.Lock()
+metrics_lock = threading.Lock()
 
 
 def debug_output(s):
@@ -45,123 +81,1243 @@ def get_py_path():
 	else:
 		return None
 
-def get_absolute_url(url):
+# other unit to px, using 96dpi and 16px font size
+obj_unit_trans = {
+	None: 1,
+	"px": 1,
+	"em": 16,
+	"ex": 8,
+	"in": 96,
+	"cm": 37.8,
+	"mm": 3.78,
+	"pt": 1.33,
+	"pc": 16,
+}
+obj_width_regex = re.compile(r"(^|[^\w\-])width\s*:\s*(\d+)\s*(px|em|ex|in|cm|mm|pt|pc)?([^\w\-]|$)")
+obj_height_regex = re.compile(r"(^|[^\w\-])height\s*:\s*(\d+)\s*(px|em|ex|in|cm|mm|pt|pc)?([^\w\-]|$)")
+subtitle_regex = re.compile(r"^【(\d{0,2})】(.*)")
+# bumped when the intermediate representation changes, see "ir_dump"
+ir_version = 1
+
+
+class Runtime(typing.NamedTuple):
+	'''\
+	Configuration used by hot paths, loaded once by "load_runtime" with regexes precompiled and rules parsed.
+	Functions using it take it as [runtime:Runtime] and pass it down, and the one loaded by "init_config" is used if not given.
+	'''
+	download_img: bool
+	override_file: bool
+	prompt_on_unsure: bool
+	prompt_on_failure: bool
+	default_img_ext: str
+	face_width_max: int
+	face_height_max: int
+	face_ident: str
+	failed_ident: str
+	failed_img: str
+	thread_count: int
+	user_agent: str
+	referer: str
+	download_max_retry: int
+	retry_backoff: float
+	retry_backoff_max: float
+	url_switch: typing.Dict[str, str]
+	url_switch_regex: typing.Optional[re.Pattern]
+	src_hooks: typing.Tuple[typing.Tuple[str, str, typing.Callable, tuple], ...]
+	head_regex: re.Pattern
+	tail_regex: re.Pattern
+	epilogue_regex: re.Pattern
+	iframe_src_regex: re.Pattern
+	remove_para_regex: re.Pattern
+
+def load_runtime(config):
+	'''\
+	Load hot path configuration from [config:configparser.ConfigParser].
+	Return: Runtime
+	'''
+	url_switch = {}
+	data = config["NETWORK"]["URLSwitch"]
+	if data:
+		for switch in data.strip().split(","):
+			pair = switch.split("->")
+			assert len(pair) == 2, "Config Error!\n  Invalid URL switch '{}'.".format(switch)
+			url_switch[pair[0].strip()] = pair[1].strip()
+	url_switch_regex = None
+	if url_switch:
+		# longer rules first, so that the most specific one wins
+		url_switch_regex = re.compile("|".join(re.escape(key) for key in sorted(url_switch, key=len, reverse=True)))
+	hook_map = {
+		"replace": hook_replace,
+		"regex": hook_regex,
+	}
+	src_hooks = []
+	for key, args in config["SOURCEHOOK"].items():
+		pair = key.split("@")
+		assert len(pair) == 2, "Config Error!\n  Invalid source hook key '{}'.".format(key)
+		hook_func = hook_map.get(pair[1].strip())
+		assert hook_func, "Config Error!\n  Invalid source hook key '{}'.".format(key)
+		arg_pair = args.split("->")
+		assert len(arg_pair) == 2, "Config Error!\n  Invalid source hook arguments '{}'.".format(args)
+		arg_pair = tuple(arg.strip().encode(encoding="UTF-8") for arg in arg_pair)
+		if hook_func == hook_regex:
+			arg_pair = (re.compile(arg_pair[0]), arg_pair[1])
+		src_hooks.append((pair[0].strip().lower(), key, hook_func, arg_pair))
+	return Runtime(
+		download_img=config["TUGUA"].getboolean("DownloadImg"),
+		override_file=config["NETWORK"].getboolean("OverrideFile"),
+		prompt_on_unsure=config["CORRECTION"].getboolean("PromptOnUnsure"),
+		prompt_on_failure=config["CORRECTION"].getboolean("PromptOnFailure"),
+		default_img_ext=config["CORRECTION"]["DefaultImgExt"],
+		face_width_max=config["CORRECTION"].getint("FaceImgWidthMax"),
+		face_height_max=config["CORRECTION"].getint("FaceImgHeightMax"),
+		face_ident=config["IDENT"]["Face"],
+		failed_ident=config["IDENT"]["Failed"],
+		failed_img=config["STYLE"]["FailedImgFile"],
+		thread_count=max(config["NETWORK"].getint("ThreadCount"), 1),
+		user_agent=config["NETWORK"]["UserAgent"],
+		referer=config["NETWORK"]["Referer"],
+		download_max_retry=config["NETWORK"].getint("DownloadMaxRetry"),
+		retry_backoff=config["NETWORK"].getfloat("RetryBackoff"),
+		retry_backoff_max=config["NETWORK"].getfloat("RetryBackoffMax"),
+		url_switch=url_switch,
+		url_switch_regex=url_switch_regex,
+		src_hooks=tuple(src_hooks),
+		head_regex=re.compile(config["SOURCECONF"]["HeadRegex"]),
+		tail_regex=re.compile(config["SOURCECONF"]["TailRegex"]),
+		epilogue_regex=re.compile(config["SOURCECONF"]["EpilogueRegex"]),
+		iframe_src_regex=re.compile(config["SOURCECONF"]["IframeSrcRegex"]),
+		remove_para_regex=re.compile(config["SOURCECONF"]["RemoveParaRegex"]),
+	)
+
+def get_runtime():
+	'''\
+	Get the runtime configuration loaded by "init_config", for functions not given one.
+	Return: Runtime
+	'''
+	return runtime
+
+def get_absolute_url(url, base=None):
+	'''\
+	Get absolute url of [url:str] relative to page [base:str], and fix duplicated scheme prefix.
+	Return: str
+	'''
 	if url.startswith("data:"):
 		return url
 	if url.startswith("http://http://") or url.startswith("http://https://"):
 		url = url[7:]
 	elif url.startswith("https://http://") or url.startswith("https://https://"):
 		url = url[8:]
-	global urlsrc
-	if urlsrc is None:
+	if base is None:
 		return url
-	url = urllib.parse.urljoin(urlsrc, url)
+	url = urllib.parse.urljoin(base, url)
 	res = urllib.parse.urlparse(url)
 	path = os.path.normpath(res.path)
 	path = path.replace("\\", "/")
 	return urllib.parse.urlunparse((res.scheme, res.netloc, path, res.params, res.query, res.fragment))
 
-def switch_url(url):
-	global urlswitch
-	if urlswitch is None:
-		urlswitch = {}
-		data = config["NETWORK"]["URLSwitch"]
-		if data:
-			for switch in data.strip().split(","):
-				pair = switch.split("->")
-				assert len(pair) == 2, "Config Error!\n  Invalid URL switch '{}'.".format(switch)
-				urlswitch[pair[0].strip()] = pair[1].strip()
-	for key in urlswitch:
-		url = url.replace(key, urlswitch[key])
-	return url
-
-def down_url(url, path, override=None, referer=None, hook=None):
-	'''\
-	Download a web page [url:str] and save to file with [path:str].
-	Return: Bool
-	'''
-	url = get_absolute_url(url)
-	url = switch_url(url)
+def switch_url(url, runtime=None):
+	'''\
+	Rewrite [url:str] by "URLSwitch" rules in a single pass.
+	Return: str
+	'''
+	runtime = runtime or get_runtime()
+	if runtime.url_switch_regex is None:
+		return url
+	return runtime.url_switch_regex.sub(lambda match: runtime.url_switch[match.group(0)], url)
+
+class ConnectionPool(object):
+	'''\
+	Keep-alive HTTP/1.1 connections grouped by host, shared by all download threads.
+	Each connection is used by one request at a time, and put back for reusing when its response is fully read.
+	Connections to hosts known ahead can be opened in background by "prewarm".
+	'''
+	redirect_codes = (301, 302, 303, 307, 308)
+	redirect_max = 10
+	warmer_count = 4
+	
+	def __init__(self, timeout=None):
+		self.timeout = timeout
+		self.lock = threading.Lock()
+		self.idle = {}  # (scheme, host, port) -> [HTTPConnection]
+		self.stats = {}  # host -> [requests, connections, prewarmed connections]
+		self.warmer = None
+	
+	@staticmethod
+	def get_key(url):
+		'''\
+		Return: (tuple, str) - (scheme, host, port) of [url:str] and the path to request
+		'''
+		res = urllib.parse.urlsplit(url)
+		port = res.port or (443 if res.scheme == "https" else 80)
+		path = urllib.parse.urlunsplit(("", "", res.path or "/", res.query, ""))
+		return ((res.scheme, res.hostname, port), path)
+	
+	def new_conn(self, scheme, host, port):
+		proxy = urllib.request.getproxies().get(scheme)
+		if proxy and urllib.request.proxy_bypass(host):
+			proxy = None
+		if proxy:
+			proxy = urllib.parse.urlparse(proxy if "://" in proxy else "http://" + proxy)
+		if scheme == "https":
+			if proxy:
+				conn = client.HTTPSConnection(proxy.hostname, proxy.port, timeout=self.timeout, context=ssl.create_default_context())
+				conn.set_tunnel(host, port)
+			else:
+				conn = client.HTTPSConnection(host, port, timeout=self.timeout, context=ssl.create_default_context())
+			conn.is_proxy = False
+		else:
+			if proxy:
+				conn = client.HTTPConnection(proxy.hostname, proxy.port, timeout=self.timeout)
+			else:
+				conn = client.HTTPConnection(host, port, timeout=self.timeout)
+			conn.is_proxy = bool(proxy)
+		return conn
+	
+	def acquire(self, key):
+		'''\
+		Get an idle connection of [key:tuple], or create a new one.
+		Return: (http.client.HTTPConnection, bool) - connection and whether it is reused
+		'''
+		with self.lock:
+			stat = self.stats.setdefault(key[1], [0, 0, 0])
+			stat[0] += 1
+			conns = self.idle.get(key)
+			if conns:
+				return (conns.pop(), True)
+			stat[1] += 1
+		return (self.new_conn(*key), False)
+	
+	def release(self, key, conn, response):
+		if response.isclosed() and not response.will_close:
+			with self.lock:
+				self.idle.setdefault(key, []).append(conn)
+		else:
+			conn.close()
+	
+	def send(self, url, headers):
+		'''\
+		Send GET request of [url:str] with [headers:dict], retry once with a new connection if the reused one is stale.
+		Return: (tuple, http.client.HTTPConnection, http.client.HTTPResponse)
+		'''
+		(key, path) = self.get_key(url)
+		while True:
+			(conn, reused) = self.acquire(key)
+			try:
+				conn.request("GET", url if conn.is_proxy else path, headers=headers)
+				return (key, conn, conn.getresponse())
+			except (client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+				conn.close()
+				if not reused:
+					raise
+			except:
+				conn.close()
+				raise
+	
+	@contextlib.contextmanager
+	def urlopen(self, url, headers):
+		'''\
+		Open [url:str] with [headers:dict] following redirections, works like "urllib.request.urlopen".
+		Non-http urls (such as "data:") are passed to urllib directly.
+		Return: http.client.HTTPResponse
+		'''
+		if not url.startswith("http://") and not url.startswith("https://"):
+			with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout) as response:
+				yield response
+			return
+		for redirect in range(self.redirect_max + 1):
+			try:
+				(key, conn, response) = self.send(url, headers)
+			except socket.timeout:
+				raise
+			except OSError as err:
+				raise urllib.error.URLError(err)
+			try:
+				if response.status in self.redirect_codes and response.getheader("Location") and redirect < self.redirect_max:
+					response.read()
+					url = urllib.parse.urljoin(url, response.getheader("Location"))
+					continue
+				if response.status >= 400:
+					response.read()
+					raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+				yield response
+			finally:
+				self.release(key, conn, response)
+			return
+	
+	def prewarm(self, urls, per_host=1):
+		'''\
+		Open connections to hosts of http [urls:list(str)] in background and put them into the idle pool, so that DNS lookup and TCP and TLS handshakes are done before the first requests.
+		Each host gets [per_host:int] idle connections at most, and no more than its urls.
+		Return: None
+		'''
+		counts = {}
+		for url in urls:
+			if url.startswith("http://") or url.startswith("https://"):
+				(key, _) = self.get_key(url)
+				counts[key] = counts.get(key, 0) + 1
+		with self.lock:
+			if self.warmer is None:
+				self.warmer = ThreadPoolExecutor(max_workers=self.warmer_count)
+			for (key, count) in counts.items():
+				for _ in range(min(count, per_host) - len(self.idle.get(key, []))):
+					self.warmer.submit(self.warm, key)
+	
+	def warm(self, key):
+		conn = self.new_conn(*key)
+		try:
+			conn.connect()
+		except OSError as err:
+			conn.close()
+			logger.info("Prewarming connection to '{}' failed: {}".format(key[1], str(err)))
+			return
+		with self.lock:
+			self.stats.setdefault(key[1], [0, 0, 0])[2] += 1
+			self.idle.setdefault(key, []).append(conn)
+	
+	def close(self):
+		if self.warmer is not None:
+			self.warmer.shutdown(wait=True, cancel_futures=True)
+			self.warmer = None
+		with self.lock:
+			for conns in self.idle.values():
+				for conn in conns:
+					conn.close()
+			self.idle.clear()
+	
+	def report(self):
+		for host in sorted(self.stats):
+			(requests, connections, prewarmed) = self.stats[host]
+			logger.info("Connection pool: {} requests to '{}' over {} connections ({} prewarmed), {} reused.".format(requests, host, connections + prewarmed, prewarmed, requests - connections))
+
+def get_connpool():
+	global connpool
+	with global_lock:
+		if connpool is None:
+			connpool = ConnectionPool(timeout=config["NETWORK"].getint("DownloadTimeout"))
+	return connpool
+
+def get_downlimit():
+	'''\
+	Get the semaphore limiting concurrent downloads of all tugua dates, to "DownloadConcurrency" at most.
+	Return: threading.BoundedSemaphore
+	'''
+	global downlimit
+	with global_lock:
+		if downlimit is None:
+			downlimit = threading.BoundedSemaphore(max(config["NETWORK"].getint("DownloadConcurrency"), 1))
+	return downlimit
+
+def close_connpool():
+	global connpool
+	global hostlimit
+	if connpool is not None:
+		connpool.report()
+		connpool.close()
+		connpool = None
+	if hostlimit is not None:
+		hostlimit.report()
+		hostlimit = None
+
+class HostLimiter(object):
+	'''\
+	Concurrent download limit of each host, adjusted by additive increase and multiplicative decrease (AIMD).
+	The limit of a host grows by one for every "limit" healthy responses, whose latency is under [slow_latency:float] seconds, up to [maximum:int].
+	It is halved on timeouts, broken transfers and throttling responses, down to one.
+	'''
+	def __init__(self, initial, maximum, slow_latency):
+		self.initial = max(initial, 1)
+		self.maximum = max(maximum, self.initial)
+		self.slow_latency = slow_latency
+		self.cond = threading.Condition()
+		self.hosts = {}
+	
+	def get_host(self, host):
+		if host not in self.hosts:
+			self.hosts[host] = {"limit": float(self.initial), "peak": self.initial, "active": 0, "files": 0, "bytes": 0, "failures": 0, "first": None, "last": None}
+		return self.hosts[host]
+	
+	@contextlib.contextmanager
+	def slot(self, host):
+		'''\
+		Wait until [host:str] has a free slot under its limit and hold it, no limit if [host] is None.
+		'''
+		if host is None:
+			yield
+			return
+		with self.cond:
+			state = self.get_host(host)
+			while state["active"] >= int(state["limit"]):
+				self.cond.wait()
+			state["active"] += 1
+			if state["first"] is None:
+				state["first"] = time.perf_counter()
+		try:
+			yield
+		finally:
+			with self.cond:
+				state["active"] -= 1
+				state["last"] = time.perf_counter()
+				self.cond.notify_all()
+	
+	def success(self, host, size, latency):
+		'''\
+		Count a response of [size:int] bytes from [host:str] which started after [latency:float] seconds.
+		Return: None
+		'''
+		if host is None:
+			return
+		with self.cond:
+			state = self.get_host(host)
+			state["files"] += 1
+			state["bytes"] += size
+			if latency < self.slow_latency and state["limit"] < self.maximum:
+				state["limit"] = min(state["limit"] + 1 / int(state["limit"]), self.maximum)
+				state["peak"] = max(state["peak"], int(state["limit"]))
+				self.cond.notify_all()
+	
+	def failure(self, host):
+		'''\
+		Count a timeout or throttled response of [host:str].
+		Return: None
+		'''
+		if host is None:
+			return
+		with self.cond:
+			state = self.get_host(host)
+			state["failures"] += 1
+			state["limit"] = max(state["limit"] / 2, 1.0)
+	
+	def report(self):
+		for host in sorted(self.hosts):
+			state = self.hosts[host]
+			seconds = (state["last"] or 0) - (state["first"] or 0)
+			speed = state["bytes"] / 1024 / seconds if seconds > 0 else 0
+			logger.info("Host '{}': {} files, {:.1f} KB/s, {} failures, concurrency {} at last and {} at most.".format(host, state["files"], speed, state["failures"], int(state["limit"]), state["peak"]))
+
+def get_hostlimit():
+	'''\
+	Get the per host download limiter, starting from "HostConcurrency" up to "HostConcurrencyMax" for each host.
+	Return: HostLimiter
+	'''
+	global hostlimit
+	with global_lock:
+		if hostlimit is None:
+			conf = config["NETWORK"]
+			hostlimit = HostLimiter(conf.getint("HostConcurrency"), conf.getint("HostConcurrencyMax"), conf.getfloat("HostSlowLatency"))
+	return hostlimit
+
+class Metrics(object):
+	'''\
+	Counters and stage timers of converting one tugua date, shared by all its download threads.
+	Downloads are also summed up by host, and everything is appended to "MetricsFile" as one JSON line by "store".
+	'''
+	def __init__(self, date_str, url=""):
+		self.lock = threading.Lock()
+		self.date = date_str
+		self.url = url
+		self.start = time.time()
+		self.begin = time.perf_counter()
+		self.last = self.begin
+		self.seconds = {}
+		self.counts = {}
+		self.hosts = {}
+	
+	def lap(self, stage):
+		'''\
+		Add time since the previous lap into [stage:str].
+		Return: None
+		'''
+		now = time.perf_counter()
+		with self.lock:
+			self.seconds[stage] = self.seconds.get(stage, 0.0) + now - self.last
+			self.last = now
+	
+	def count(self, name, value=1):
+		with self.lock:
+			self.counts[name] = self.counts.get(name, 0) + value
+	
+	def download(self, url, size, seconds, retries):
+		'''\
+		Count a download of [url:str] which took [seconds:float] and [retries:int] retries, [size:int] is None if it failed at last.
+		Return: None
+		'''
+		parts = urllib.parse.urlsplit(url)
+		host = parts.netloc or parts.scheme
+		if size is None:
+			values = {"retries": retries, "failures": 1}
+		else:
+			values = {"files": 1, "bytes": size, "retries": retries}
+		with self.lock:
+			stats = self.hosts.setdefault(host, {"files": 0, "bytes": 0, "retries": 0, "failures": 0, "seconds": 0.0})
+			for (key, value) in values.items():
+				stats[key] += value
+				self.counts[key] = self.counts.get(key, 0) + value
+			stats["seconds"] += seconds
+	
+	def store(self, path, error=None):
+		'''\
+		Append metrics as a JSON line into file [path:str], with [error:Exception] if failed.
+		Return: None
+		'''
+		with self.lock:
+			seconds = dict(self.seconds, total=time.perf_counter() - self.begin)
+			line = {
+				"date": self.date,
+				"url": self.url,
+				"start": datetime.datetime.fromtimestamp(self.start).isoformat(timespec="seconds"),
+				"status": "error" if error else "ok",
+				"error": repr(error) if error else None,
+				"seconds": {key: round(value, 4) for (key, value) in seconds.items()},
+				"counts": dict(self.counts),
+				"hosts": {host: dict(stats, seconds=round(stats["seconds"], 4)) for (host, stats) in self.hosts.items()},
+			}
+		with metrics_lock:
+			with open(path, "a", encoding="UTF-8") as metrics_file:
+				metrics_file.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+def get_source_path(path):
+	'''\
+	Get the stored file of source page [path:str], which is "[path].gz" if it exists, or if "SrcCompress" is enabled and [path] does not exist.
+	Return: str
+	'''
+	if os.path.isfile(path + ".gz"):
+		return path + ".gz"
+	if os.path.isfile(path) or not config["TUGUA"].getboolean("SrcCompress"):
+		return path
+	return path + ".gz"
+
+def read_source(path):
+	'''\
+	Read stored source page [path:str] got by "get_source_path", decompressed if it is a gzip file.
+	Return: bytes
+	'''
+	with open(path, "rb") as src_file:
+		data = src_file.read()
+	if path.endswith(".gz"):
+		data = gzip.decompress(data)
+	return data
+
+def load_validator(path):
+	'''\
+	Load HTTP validators stored next to file [path:str].
+	Return: dict - with "url", "etag" and "last-modified", empty if not found
+	'''
+	validator_path = path + ".validator"
+	if not os.path.isfile(validator_path):
+		return {}
+	try:
+		with open(validator_path, "r", encoding="UTF-8") as validator_file:
+			return json.load(validator_file)
+	except ValueError:
+		logger.warning("Invalid validator file '{}', ignored.".format(validator_path))
+		return {}
+
+def store_validator(path, url, response):
+	'''\
+	Store HTTP validators of [response:http.client.HTTPResponse] from [url:str] next to file [path:str].
+	Return: None
+	'''
+	validator = {"url": url}
+	if response.getheader("ETag"):
+		validator["etag"] = response.getheader("ETag")
+	if response.getheader("Last-Modified"):
+		validator["last-modified"] = response.getheader("Last-Modified")
+	with open(path + ".validator", "w", encoding="UTF-8") as validator_file:
+		json.dump(validator, validator_file)
+
+def down_url(url, path, override=None, referer=None, hook=None, validate=False, head_hook=None, stats=None, compress=False, runtime=None):
+	'''\
+	Download a web page [url:str] and save to file with [path:str], or return the data when [path] is None.
+	The response is streamed into "[path].part" and renamed when complete, and an interrupted transfer is resumed by a "Range" request on retry.
+	When [compress:bool] is True, the file is stored gzip compressed, see "read_source".
+	Retries wait for an exponential backoff of "RetryBackoff" seconds with full jitter, capped to "RetryBackoffMax".
+	Requests are limited by "DownloadConcurrency" in total and by "HostLimiter" for each host, which is told about latency, timeouts and throttling.
+	When [validate:bool] is True, HTTP validators are stored next to the file, and an existing file is only downloaded again when the server reports it modified.
+	While receiving, [head_hook:(bool)method(head:bytes)] is called with the first bytes of the response each time more arrive, until it returns True or "head_max" bytes are read.
+	Each download is counted into [stats:Metrics] if given.
+	Return: Bool, or bytes when [path] is None
+	'''
+	runtime = runtime or get_runtime()
+	head_max = 1 << 16
+	# validators keep the url asked for, since it is read back as the page link, not the one switched to
+	orig_url = get_absolute_url(url)
+	url = switch_url(orig_url, runtime=runtime)
 	if override == None:
-		override = config["NETWORK"].getboolean("OverrideFile")
-	if os.path.isfile(path) and os.path.getsize(path) > 0 and not override:
+		override = runtime.override_file
+	exists = path is not None and os.path.isfile(path) and os.path.getsize(path) > 0
+	if exists and not override:
 		logger.info("File {} already exists, skip downloading.".format(path))
 		return True
-	logger.info("Downloading {} to {} ...".format(url, path))
-	refer = config["NETWORK"]["Referer"]
+	logger.info("Downloading {} to {} ...".format(url, path or "memory"))
+	refer = runtime.referer
 	if referer is not None:
 		refer = referer
-	elif urlsrc is not None:
-		refer = urlsrc
-	headers = {"User-Agent": config["NETWORK"]["UserAgent"], "Referer": refer}
-	for retry in range(config["NETWORK"].getint("DownloadMaxRetry")):
+	headers = {"User-Agent": runtime.user_agent, "Referer": refer}
+	if validate and exists:
+		validator = load_validator(path)
+		if validator.get("url") == orig_url and validator.get("etag"):
+			headers["If-None-Match"] = validator["etag"]
+		if validator.get("url") == orig_url and validator.get("last-modified"):
+			headers["If-Modified-Since"] = validator["last-modified"]
+	part_path = path + ".part" if path is not None else None
+	chunks = []  # data received when [path] is None
+	received = 0
+	head = b""
+	if_range = None  # validator of the partial response, so that a changed resource is sent again in whole
+	def restart():
+		nonlocal received, head, if_range
+		if part_path and os.path.isfile(part_path):
+			os.remove(part_path)
+		chunks.clear()
+		(received, head, if_range) = (0, b"", None)
+	restart()
+	limiter = get_hostlimit()
+	start = time.perf_counter()
+	for retry in range(runtime.download_max_retry):
+		if retry > 0:
+			time.sleep(random.uniform(0, min(runtime.retry_backoff * (1 << (retry - 1)), runtime.retry_backoff_max)))
+		host = urllib.parse.urlsplit(url).netloc if url.startswith("http://") or url.startswith("https://") else None
+		request_headers = dict(headers)
+		if received:
+			request_headers["Range"] = "bytes={}-".format(received)
+			if if_range:
+				request_headers["If-Range"] = if_range
 		try:
-			request = urllib.request.Request(url, headers=headers)
-			with urllib.request.urlopen(request, timeout=config["NETWORK"].getint("DownloadTimeout")) as url_data:
-				data = url_data.read()
-				if data and hook:
+			with limiter.slot(host), get_downlimit():
+				sent = time.perf_counter()
+				with get_connpool().urlopen(url, request_headers) as url_data:
+					latency = time.perf_counter() - sent
+					status = getattr(url_data, "status", None)
+					if status == 304:
+						logger.info("File {} not modified, skip downloading.".format(path))
+						limiter.success(host, 0, latency)
+						if stats:
+							stats.download(url, 0, time.perf_counter() - start, retry)
+							stats.count("not_modified")
+						return True
+					if received and status == 206 and url_data.headers.get("Content-Range", "").startswith("bytes {}-".format(received)):
+						logger.info("Resuming {} from {} bytes ...".format(url, received))
+						if stats:
+							stats.count("resumed")
+					elif received:
+						restart()
+					if not received:
+						if_range = url_data.headers.get("ETag") or url_data.headers.get("Last-Modified")
+					offset = received
+					# a short body is not reported by chunked reads, so check it against the length announced
+					expected = None
+					range_match = re.match(r"^bytes (\d+)-(\d+)/", url_data.headers.get("Content-Range", "")) if status == 206 else None
+					if range_match:
+						expected = int(range_match.group(2)) - int(range_match.group(1)) + 1
+					elif (url_data.headers.get("Content-Length") or "").isdigit():
+						expected = int(url_data.headers.get("Content-Length"))
+					with (open(part_path, "ab") if part_path else contextlib.nullcontext()) as part_file:
+						while True:
+							chunk = url_data.read(1 << 14)
+							if not chunk:
+								break
+							if part_file:
+								part_file.write(chunk)
+							else:
+								chunks.append(chunk)
+							received += len(chunk)
+							if head_hook and head is not None:
+								head += chunk
+								if head_hook(head) or len(head) >= head_max:
+									head = None
+					if expected is not None and received - offset < expected:
+						# keep what is received, so that the retry resumes from it
+						raise client.IncompleteRead(b"", expected - (received - offset))
+					limiter.success(host, received - offset, latency)
+					if received and validate:
+						store_validator(path, orig_url, url_data)
+			if not received:
+				continue
+			if stats:
+				stats.download(url, received, time.perf_counter() - start, retry)
+			if path is None:
+				data = b"".join(chunks)
+				return hook(url, data) if hook else data
+			if hook or compress:
+				with open(part_path, "rb") as part_file:
+					data = part_file.read()
+				if hook:
 					data = hook(url, data)
-			if data:
-				with open(path, "wb") as file_data:
-					file_data.write(data)
-				return True
-		except socket.timeout:
-			pass
+				with open(part_path, "wb") as part_file:
+					part_file.write(gzip.compress(data, mtime=0) if compress else data)
+			os.replace(part_path, path)
+			return True
+		except (socket.timeout, ConnectionError):
+			limiter.failure(host)
 		except urllib.error.URLError as err:
-			if isinstance(err, urllib.error.HTTPError) and err.code == 403 and "Referer" in headers:
+			if isinstance(err, urllib.error.HTTPError) and (err.code in (403, 429) or err.code >= 500):
+				limiter.failure(host)
+			if isinstance(err, urllib.error.HTTPError) and err.code == 416:
+				restart()
+			elif isinstance(err, urllib.error.HTTPError) and err.code == 403 and "Referer" in headers:
 				del headers["Referer"]
 			else:
 				logger.warning("Download URLError: {}".format(str(err)))
 		except client.IncompleteRead as err:
+			limiter.failure(host)
 			if retry > 0 and url.startswith("https://"):
 				url = "http://" + url[8:]
 			else:
 				logger.warning("Download IncompleteRead: {}".format(str(err)))
-	logger.error("Download {} to {} failed.".format(url, path))
+	restart()
+	logger.error("Download {} to {} failed.".format(url, path or "memory"))
+	if stats:
+		stats.download(url, None, time.perf_counter() - start, runtime.download_max_retry - 1)
 	return False
 
-def parse_html(data):
+def get_img_ext(url):
+	'''\
+	Guess image extension from [url:str], either a data url or a normal one.
+	Return: str - None if not found
+	'''
+	ext_match = re.search(r"^data:image/(\w+);|\.(\w+)$|\.(\w+)\?", url)
+	if not ext_match:
+		return None
+	ext = ext_match.group(1) or ext_match.group(2) or ext_match.group(3)
+	ext = ext.lower()
+	if ext == "jpeg":
+		ext = "jpg"
+	return ext
+
+def decode_data_url(url):
+	'''\
+	Decode data url [url:str] natively, in base64 or percent encoding.
+	Return: bytes - None if invalid
+	'''
+	url_match = re.match(r"^data:([^,]*?)(;base64)?,(.*)$", url, re.S)
+	if not url_match:
+		return None
+	try:
+		if url_match.group(2):
+			data = re.sub(r"\s+", "", urllib.parse.unquote(url_match.group(3)))
+			return base64.b64decode(data + "=" * (-len(data) % 4), validate=True)
+		return urllib.parse.unquote_to_bytes(url_match.group(3))
+	except ValueError:
+		return None
+
+class ImgSniffer(object):
+	'''\
+	Recognize image format and size from the first bytes of an image, without decoding it.
+	'''
+	def __init__(self):
+		self.format = None
+		self.size = None
+	
+	def feed(self, head):
+		'''\
+		Try to recognize image from [head:bytes], the beginning of image data.
+		Return: bool - True if recognized
+		'''
+		try:
+			with Image.open(io.BytesIO(head)) as img:
+				self.format = (img.format or "").lower() or None
+				self.size = img.size
+		except (OSError, SyntaxError, ValueError):
+			return False
+		if self.format == "jpeg":
+			self.format = "jpg"
+		return True
+	
+	def is_face(self, runtime=None):
+		runtime = runtime or get_runtime()
+		if not self.size:
+			return False
+		(img_width, img_height) = self.size
+		return img_width <= runtime.face_width_max and img_height <= runtime.face_height_max
+
+class ImgCache(object):
+	'''\
+	Persistent image store shared by all dates, with url to content hash records and a blob directory.
+	Records are appended to "urls.txt" as "hash\turl" lines, blobs are stored as "xx/hash" and hard linked into date folders.
+	'''
+	def __init__(self, cache_dir):
+		self.cache_dir = cache_dir
+		self.record_path = os.path.join(cache_dir, "urls.txt")
+		self.lock = threading.Lock()
+		self.urls = {}
+		self.hits = 0
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		if os.path.isfile(self.record_path):
+			with open(self.record_path, "r", encoding="UTF-8") as record_file:
+				for line in record_file:
+					pair = line.rstrip("\n").split("\t", 1)
+					if len(pair) == 2:
+						self.urls[pair[1]] = pair[0]
+	
+	def blob_path(self, digest):
+		return os.path.join(self.cache_dir, digest[:2], digest)
+	
+	def contains(self, url):
+		with self.lock:
+			return url in self.urls
+	
+	def find(self, url):
+		'''\
+		Find cached image of [url:str].
+		Return: str - blob path, None if not cached
+		'''
+		with self.lock:
+			digest = self.urls.get(url)
+		if not digest or not os.path.isfile(self.blob_path(digest)):
+			return None
+		with self.lock:
+			self.hits += 1
+		logger.info("Image {} found in cache.".format(url))
+		return self.blob_path(digest)
+	
+	def save_file(self, url, src_path, path):
+		'''\
+		Move downloaded image file [src_path:str] of [url:str] to [path:str] and add it into cache, hashing it in chunks instead of reading it whole.
+		The file is linked to the blob and [src_path] removed instead if identical bytes are already cached.
+		Return: None
+		'''
+		digest = hashlib.sha1()
+		with open(src_path, "rb") as src_file:
+			for chunk in iter(lambda: src_file.read(1 << 16), b""):
+				digest.update(chunk)
+		digest = digest.hexdigest()
+		blob_path = self.blob_path(digest)
+		with self.lock:
+			if os.path.isfile(blob_path):
+				link_file(blob_path, path)
+				os.remove(src_path)
+			else:
+				os.replace(src_path, path)
+				if os.path.isfile(src_path):
+					os.remove(src_path)
+				if not os.path.isdir(os.path.dirname(blob_path)):
+					os.makedirs(os.path.dirname(blob_path))
+				link_file(path, blob_path)
+			self.add_url(url, digest)
+	
+	def add_url(self, url, digest):
+		'''\
+		Record that [url:str] is cached as blob [digest:str], called with the lock held.
+		Return: None
+		'''
+		if self.urls.get(url) != digest:
+			self.urls[url] = digest
+			with open(self.record_path, "a", encoding="UTF-8") as record_file:
+				record_file.write("{}\t{}\n".format(digest, url))
+
+def get_imgcache(directory):
+	'''\
+	Get the image cache under tugua [directory:str], configured by "ImgCacheDir".
+	Return: ImgCache - None if disabled
+	'''
+	global imgcache
+	if not config["TUGUA"]["ImgCacheDir"]:
+		return None
+	cache_dir = os.path.join(directory, config["TUGUA"]["ImgCacheDir"])
+	with global_lock:
+		if imgcache is None or imgcache.cache_dir != cache_dir:
+			imgcache = ImgCache(cache_dir)
+	return imgcache
+
+def link_file(src, dst):
+	'''\
+	Hard link [src:str] to [dst:str] replacing it, or copy when hard link is not supported.
+	Return: None
+	'''
+	if os.path.isfile(dst):
+		os.remove(dst)
+	try:
+		os.link(src, dst)
+	except OSError:
+		shutil.copyfile(src, dst)
+
+def transcode_image(src_path, dst_path, max_size, min_bytes, img_format, quality):
+	'''\
+	Encode image [src_path:str] again as [dst_path:str] in [img_format:str] with [quality:int], shrunk to fit in [max_size:int] pixels square.
+	Images within [max_size] and smaller than [min_bytes:int], animated images, transparent images to non-alpha formats, and results not smaller are skipped.
+	It runs in transcoder processes, and the file is written aside and then renamed, so linked files are never modified in place.
+	Return: int - bytes saved, None if skipped
+	'''
+	src_bytes = os.path.getsize(src_path)
+	if os.path.isfile(dst_path) and os.path.getmtime(dst_path) >= os.path.getmtime(src_path):
+		return src_bytes - os.path.getsize(dst_path)
 	result = None
-	encode = config["TUGUA"]["SrcEncoding"]
-	parser = config["TUGUA"]["HtmlParser"]
-	if encode:
-		for enc in encode.split():
-			try:
-				tmp = data.decode(enc)
-				tmp = re.subn(r"<\s*br\s*>", "<br />", tmp)[0]  # avoid illegal br tag
-				result = BeautifulSoup(tmp, parser)
-				logger.info("Decoding success by '{}'".format(enc))
-				break
-			except Exception as e:
-				logger.warning("Try to decode using '{}' failed: {}".format(enc, str(e)))
-	if not result:
-		result = BeautifulSoup(data, parser)
+	tmp_path = dst_path + ".tmp"
+	try:
+		with Image.open(src_path) as img:
+			if getattr(img, "is_animated", False):
+				return None
+			if max(img.size) <= max_size and src_bytes < min_bytes:
+				return None
+			has_alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+			if has_alpha and img_format == "JPEG":
+				return None
+			img = img.convert("RGBA" if has_alpha else "RGB")
+			img.thumbnail((max_size, max_size), Image.LANCZOS)
+			img.save(tmp_path, img_format, quality=quality)
+		dst_bytes = os.path.getsize(tmp_path)
+		if dst_bytes < src_bytes:
+			os.replace(tmp_path, dst_path)
+			result = src_bytes - dst_bytes
+	except (OSError, SyntaxError, ValueError):
+		pass
+	finally:
+		if os.path.isfile(tmp_path):
+			os.remove(tmp_path)
+	if result is None and os.path.isfile(dst_path):
+		os.remove(dst_path)
 	return result
 
-def tugua_analyze(tag_src, soup_tmpl, stop_func=None, search_sibling = True):
+class Transcoder(object):
+	'''\
+	Pool of processes re-encoding oversized images in background by "transcode_image", configured by [TRANSCODE] section.
+	The transcoded image of "[stem].[ext]" is written as "[stem].min.[format]" beside the original one.
+	'''
+	def __init__(self, processes):
+		conf = config["TRANSCODE"]
+		self.ext = conf["Format"].lower()
+		self.img_format = Image.registered_extensions().get("." + self.ext)
+		assert self.img_format, "Config Error!\n  Unsupported transcode format '{}'.".format(conf["Format"])
+		self.args = (conf.getint("MaxDimension"), conf.getint("MinSize") * 1024, self.img_format, conf.getint("Quality"))
+		self.executor = ProcessPoolExecutor(max_workers=processes) if processes > 1 else None
+	
+	def submit(self, img_path):
+		'''\
+		Start transcoding image [img_path:str].
+		Return: (str, concurrent.futures.Future) - the transcoded file name and the future of "transcode_image"
+		'''
+		(stem, _) = os.path.splitext(img_path)
+		dst_path = "{}.min.{}".format(stem, self.ext)
+		if self.executor:
+			future = self.executor.submit(transcode_image, img_path, dst_path, *self.args)
+		else:
+			future = Future()
+			future.set_result(transcode_image(img_path, dst_path, *self.args))
+		return (os.path.basename(dst_path), future)
+	
+	def close(self):
+		if self.executor:
+			self.executor.shutdown(wait=True)
+
+def get_transcoder():
+	'''\
+	Get the image transcoder with "ProcessCount" processes, one for each cpu if it is 0.
+	Inside a rebuild worker it transcodes in the calling thread, since dates are already spread over processes.
+	Return: Transcoder - None if "TranscodeImg" is disabled
+	'''
+	global transcoder
+	if not config["TRANSCODE"].getboolean("TranscodeImg"):
+		return None
+	with global_lock:
+		if transcoder is None:
+			processes = config["TRANSCODE"].getint("ProcessCount") or os.cpu_count()
+			if multiprocessing.parent_process() is not None:
+				processes = 1
+			transcoder = Transcoder(processes)
+	return transcoder
+
+def close_transcoder():
+	global transcoder
+	if transcoder is not None:
+		transcoder.close()
+		transcoder = None
+
+def down_img(url, img_dir="", referer=None, stats=None, runtime=None):
+	'''\
+	Download image [url:str] with [referer:str] into a temporary file under [img_dir:str], streamed and resumed by "down_url", with format and size sniffed from the first bytes.
+	Each download is counted into [stats:Metrics] if given.
+	Return: (ImgSniffer, str) - image info and the temporary file path to be moved into place, None if failed
+	'''
+	runtime = runtime or get_runtime()
+	sniffer = ImgSniffer()
+	tmp_path = os.path.join(img_dir, ".{}.download".format(hashlib.sha1(url.encode("UTF-8")).hexdigest()))
+	if not down_url(url, tmp_path, override=True, referer=referer, head_hook=sniffer.feed, stats=stats, runtime=runtime):
+		return None
+	if not sniffer.format:
+		with open(tmp_path, "rb") as tmp_file:
+			sniffer.feed(tmp_file.read())
+	return (sniffer, tmp_path)
+
+def tugua_images(parts, img_dir="", img_info={}, referer=None, img_cache=None, hook=None, local=None, existing=None, stats=None, transcoder=None, fail_hook=None, failed=None, runtime=None):
+	'''\
+	Download images under [parts:list((str, bs4.element.Tag))] of (section_id, node) into [img_dir:str] with [referer:str], and update the img tags.
+	Images are downloaded by a pool of "ThreadCount" threads into temporary files by "down_img", and moved into place when complete.
+	Results are handled in document order, so each image is written once as "[section_id]_%count%.%ext%" or "face_%count%.%ext%" no matter which download finishes first.
+	To avoid duplicated face image, the url of face image will be stored in [img_info:dict], and face img tags get the face class.
+	Images already in [img_cache:ImgCache] are linked instead of downloaded, and new ones except data urls are added into it.
+	Unless "OverrideFile" is set, images saved by an earlier run as files of [existing:dict(str:str)] by url are reused instead of downloaded, with only their first bytes sniffed.
+	Images moved into "InlineDir" by "tugua_inline_images" are left as they are.
+	[hook:function(str, str, bool)] is called with url, file name and whether it is a face after each image is saved.
+	When [local:dict(str:str)] of image files by url is given, it works offline reusing them like [existing] without prompting, and images neither cached nor in [local] keep their urls, except those in [failed:set(str)] queued as failures already, which keep the placeholder below.
+	When [fail_hook:function(str, str, str)] is given, it is called with url, file name and reason of each failed image instead of prompting, and images failed to download are replaced by "FailedImgFile" with the url kept in "data-src".
+	Non-face images are passed to [transcoder:Transcoder] as soon as they are written, and img tags are pointed to the transcoded files when all finished.
+	Downloads, cache hits, images, faces, failed and transcoded images are counted into [stats:Metrics] if given.
+	Return: None
+	'''
+	runtime = runtime or get_runtime()
+	override = runtime.override_file
+	occurs = []
+	urls = []
+	inline_prefix = "../{}/".format(config["TUGUA"]["InlineDir"]) if config["TUGUA"]["InlineDir"] else None
+	for (section_id, tag_src) in parts:
+		for tag in tag_src.find_all("img"):
+			if inline_prefix and tag["src"].startswith(inline_prefix):
+				continue
+			occurs.append((section_id, tag))
+			url = tag["src"].strip()
+			if tag["src"] not in img_info and not url.startswith("file:") and url not in urls:
+				urls.append(url)
+	
+	def fetch(url):
+		'''\
+		Return: (ImgSniffer, str, bool) - image info, file path if cached, downloaded or found on disk and whether the file is temporary, None if failed
+		'''
+		sniffer = ImgSniffer()
+		cache = img_cache if not url.startswith("data:") else None
+		blob_path = cache.find(url) if cache and (not override or local is not None) else None
+		if blob_path:
+			with open(blob_path, "rb") as blob_file:
+				sniffer.feed(blob_file.read(1 << 16))
+			if stats:
+				stats.count("cache_hits")
+			return (sniffer, blob_path, False)
+		if local is not None and not url.startswith("data:"):
+			file_path = local.get(url)
+		else:
+			file_path = existing.get(url) if existing and not override else None
+		if file_path and os.path.isfile(file_path):
+			# linked as a temporary file like a download, so that it survives another image taking its name
+			with open(file_path, "rb") as img_file:
+				sniffer.feed(img_file.read(1 << 16))
+			tmp_path = os.path.join(img_dir, ".{}.download".format(hashlib.sha1(url.encode("UTF-8")).hexdigest()))
+			link_file(file_path, tmp_path)
+			logger.info("Image {} already exists as '{}', skip downloading.".format(url, file_path))
+			return (sniffer, tmp_path, True)
+		if local is not None and not url.startswith("data:"):
+			return None
+		result = down_img(url, img_dir, referer=referer, stats=stats, runtime=runtime)
+		return (result[0], result[1], True) if result else None
+	
+	results = {}
+	futures = []
+	threads = runtime.thread_count
+	executor = ThreadPoolExecutor(max_workers=threads)
+	window = threads * 2  # limit images downloaded but not written yet
+	def get_result(url):
+		while url not in results:
+			while len(futures) < window and len(results) + len(futures) < len(urls):
+				next_url = urls[len(results) + len(futures)]
+				futures.append((next_url, executor.submit(fetch, next_url)))
+			(done_url, future) = futures.pop(0)
+			results[done_url] = future.result()
+		return results[url]
+	
+	def placeholder(tag, url):
+		tag["data-src"] = url
+		tag["src"] = runtime.failed_img
+		tag["class"] = runtime.failed_ident
+	
+	counts = {}
+	transcodes = []
+	try:
+		for (section_id, tag) in occurs:
+			if tag["src"] in img_info:
+				tag["src"] = img_info[tag["src"]]
+				tag["class"] = runtime.face_ident
+				continue
+			url = tag["src"].strip()
+			if url.startswith("file:"):
+				logger.warning("Illegal image url '{}', ignored.".format(url))
+				tag.extract()
+				continue
+			ext = get_img_ext(tag["src"])
+			if not ext:
+				logger.warning("No extension found for image '{}', default to '{}'.".format(tag["src"], runtime.default_img_ext))
+				ext = runtime.default_img_ext
+			img_name = "{}_{:02}.{}".format(section_id, counts.get(section_id, 0)+1, ext)
+			result = get_result(url)
+			is_face = False
+			if not result and local is not None and failed and url in failed:
+				logger.warning("Image '{}' not found offline and queued as failure, keep the placeholder.".format(url))
+				counts[section_id] = counts.get(section_id, 0) + 1
+				placeholder(tag, url)
+				continue
+			elif not result and local is not None:
+				logger.warning("Image '{}' not found offline, keep the url.".format(url))
+				counts[section_id] = counts.get(section_id, 0) + 1
+				continue
+			elif not result and fail_hook:
+				logger.error("Image '{}' failed, replaced by placeholder.".format(url))
+				fail_hook(url, img_name, "download failed")
+				counts[section_id] = counts.get(section_id, 0) + 1
+				placeholder(tag, url)
+				if stats:
+					stats.count("failed")
+				continue
+			elif not result:
+				input("Continue? ")
+			else:
+				(sniffer, file_path, is_temp) = result
+				if not sniffer.size:
+					logger.error("Can't recognize image '{}', default to non-face image.".format(url))
+					if fail_hook and local is None:
+						fail_hook(url, img_name, "unrecognized")
+						if stats:
+							stats.count("failed")
+					elif local is None:
+						input("Continue? ")
+				elif not sniffer.format:
+					logger.error("Can't recognize the format of image '{}'.".format(url))
+					if runtime.prompt_on_unsure and local is None:
+						input("Continue? ")
+				else:
+					is_face = sniffer.is_face(runtime)
+					if sniffer.format != ext:
+						new_img_name = "{}_{:02}.{}".format(section_id, counts.get(section_id, 0)+1, sniffer.format)
+						logger.error("Image format mismatch, saving '{}' as '{}'.".format(img_name, new_img_name))
+						if runtime.prompt_on_unsure and local is None:
+							input("Continue? ")
+						ext = sniffer.format
+						img_name = new_img_name
+				if is_face:
+					img_name = "{}_{:02}.{}".format(runtime.face_ident, len(img_info)+1, ext)
+					logger.info("Face image found, saving as '{}'.".format(img_name))
+				img_path = os.path.join(img_dir, img_name)
+				if file_path and is_temp and img_cache and not url.startswith("data:"):
+					img_cache.save_file(url, file_path, img_path)
+				elif file_path and is_temp:
+					os.replace(file_path, img_path)
+					# renaming a link onto the same file does nothing
+					if os.path.isfile(file_path):
+						os.remove(file_path)
+				else:
+					link_file(file_path, img_path)
+				# the same url may appear again as non-face image, reuse the file written
+				results[url] = (sniffer, img_path, False)
+			if is_face:
+				img_info[tag["src"]] = img_name
+				tag["class"] = runtime.face_ident
+			else:
+				counts[section_id] = counts.get(section_id, 0) + 1
+				if transcoder and result:
+					transcodes.append((tag, transcoder.submit(img_path)))
+			if hook and result:
+				hook(tag["src"], img_name, is_face)
+			tag["src"] = img_name
+		for (tag, (min_name, future)) in transcodes:
+			saved = future.result()
+			if saved is not None:
+				tag["src"] = min_name
+				if stats:
+					stats.count("transcoded")
+					stats.count("transcode_saved", saved)
+	finally:
+		executor.shutdown(wait=True, cancel_futures=True)
+		# remove temporary files downloaded but not moved into place
+		done = list(results.values()) + [future.result() for (_, future) in futures if future.done() and not future.cancelled() and not future.exception()]
+		for result in done:
+			if result and result[2] and os.path.isfile(result[1]):
+				os.remove(result[1])
+	if stats:
+		stats.count("images", len(occurs))
+		stats.count("faces", len(set(img_info.values())))
+
+def sniff_encoding(data):
+	'''\
+	Pick the encoding of html [data:bytes] before parsing, from BOM, <meta charset> and then "SrcEncoding" candidates in order.
+	A candidate is accepted only when it can decode the whole data strictly.
+	Return: (str, str) - encoding and decoded text, (None, None) if no candidate works
+	'''
+	for (bom, enc) in ((codecs.BOM_UTF8, "UTF-8-SIG"), (codecs.BOM_UTF16_LE, "UTF-16"), (codecs.BOM_UTF16_BE, "UTF-16")):
+		if data.startswith(bom):
+			return (enc, data.decode(enc, "replace"))
+	candidates = []
+	match = re.search(rb"<meta[^>]+charset\s*=\s*[\"']?([\w\-]+)", data[:4096], re.IGNORECASE)
+	if match:
+		enc = match.group(1).decode("ascii")
+		if enc.lower() in ("gb2312", "gbk", "x-gbk"):
+			enc = "GB18030"  # superset, pages declared as gb2312 often use gbk characters
+		candidates.append(enc)
+	candidates.extend(config["TUGUA"]["SrcEncoding"].split())
+	for enc in candidates:
+		try:
+			return (enc, data.decode(enc))
+		except (UnicodeDecodeError, LookupError) as e:
+			logger.warning("Try to decode using '{}' failed: {}".format(enc, str(e)))
+	return (None, None)
+
+def get_html_parser():
+	'''\
+	Get the BeautifulSoup parser configured by "HtmlParser", such as "html.parser" or "lxml".
+	Fall back to "html.parser" when the configured one is not installed.
+	Return: str
+	'''
+	global htmlparser
+	with global_lock:
+		if htmlparser is None:
+			htmlparser = config["TUGUA"]["HtmlParser"] or "html.parser"
+			try:
+				BeautifulSoup("", htmlparser)
+			except FeatureNotFound:
+				logger.warning("Parser '{}' is not installed, fall back to 'html.parser'.".format(htmlparser))
+				htmlparser = "html.parser"
+	return htmlparser
+
+def parse_html(data):
+	'''\
+	Parse html [data:bytes] once, with encoding detected by "sniff_encoding".
+	Return: bs4.BeautifulSoup
+	'''
+	parser = get_html_parser()
+	(enc, text) = sniff_encoding(data)
+	if text is None:
+		return BeautifulSoup(data, parser)
+	logger.info("Decoding success by '{}'".format(enc))
+	text = re.subn(r"<\s*br\s*>", "<br />", text)[0]  # avoid illegal br tag
+	return BeautifulSoup(text, parser)
+
+def write_html(tag, dest_file, pretty=True, indent_level=0):
+	'''\
+	Serialize [tag:bs4.element.Tag] into text file [dest_file:file] piece by piece, instead of building the whole document as one string.
+	Frame tags without attributes (html and body) are written directly, while any other element is decoded on its own.
+	Output is the same as "tag.prettify()" if [pretty:bool], otherwise the same as "str(tag)".
+	Return: None
+	'''
+	formatter = tag.formatter_for_name("minimal")
+	(indent, newline) = (formatter.indent * indent_level, "\n") if pretty else ("", "")
+	if isinstance(tag, BeautifulSoup):
+		for child in tag.contents:
+			write_html(child, dest_file, pretty, indent_level)
+	elif isinstance(tag, Tag) and tag.name in ("html", "body") and not tag.attrs:
+		dest_file.write("{}<{}>{}".format(indent, tag.name, newline))
+		for child in tag.contents:
+			write_html(child, dest_file, pretty, indent_level + 1)
+		dest_file.write("{}</{}>{}".format(indent, tag.name, newline))
+	elif isinstance(tag, Tag):
+		dest_file.write(tag.decode(indent_level if pretty else None, formatter=formatter))
+	else:
+		piece = tag.output_ready(formatter)
+		if pretty:
+			piece = piece.strip()
+		if piece:
+			dest_file.write("{}{}{}".format(indent, piece, newline))
+	return
+
+def tugua_analyze(tag_src, soup_tmpl, stop_func=None, search_sibling = True, base_url=None, runtime=None):
 	'''\
 	Analyze tugua at specific node [tag_src:bs4.element.Tag], convert it to a new node with soup template [soup_tmpl:bs4.BeautifulSoup].
+	Relative urls are resolved against the source page [base_url:str].
 	This process stops when [stop_func:(bool)method(tag_src:bs4.element.Tag)] returns True.
 	Return: bs4.element.Tag - dest tag converted
 	Return: bs4.element.Tag - src tag stopped
 	'''
+	runtime = runtime or get_runtime()
 	tag_start = tag_src
 	tag_stop = None
 	
 	def get_obj_size(tag):
 		assert isinstance(tag, Tag), "Tag Error!\n  Expect 'tag' but actual is '{}'.".format(tag)
-		# other unit to px, using 96dpi and 16px font size
-		unit_trans = {
-			None: 1,
-			"px": 1,
-			"em": 16,
-			"ex": 8,
-			"in": 96,
-			"cm": 37.8,
-			"mm": 3.78,
-			"pt": 1.33,
-			"pc": 16,
-		}
 		width = None
 		height = None
 		if tag.get("width"):
@@ -173,17 +1329,13 @@ def tugua_analyze(tag_src, soup_tmpl, stop_func=None, search_sibling = True):
 			return (width, height)
 		style = style.lower()
 		if not width:
-			match = re.search(r"(^|[^\w\-])width\s*:\s*(\d+)\s*(px|em|ex|in|cm|mm|pt|pc)?([^\w\-]|$)", style)
+			match = obj_width_regex.search(style)
 			if match:
-				number = match.group(2)
-				unit = match.group(3)
-				width = int(number * unit_trans[unit])
+				width = int(int(match.group(2)) * obj_unit_trans[match.group(3)])
 		if not height:
-			match = re.search(r"(^|[^\w\-])height\s*:\s*(\d+)\s*(px|em|ex|in|cm|mm|pt|pc)?([^\w\-]|$)", style)
+			match = obj_height_regex.search(style)
 			if match:
-				number = match.group(2)
-				unit = match.group(3)
-				height = int(number * unit_trans[unit])
+				height = int(int(match.group(2)) * obj_unit_trans[match.group(3)])
 		return (width, height)
 	
 	def convert_object(tag):
@@ -222,7 +1374,7 @@ def tugua_analyze(tag_src, soup_tmpl, stop_func=None, search_sibling = True):
 					src = src + "?" + vars
 			result = soup_tmpl.new_tag("embed")
 			result["type"] = "application/x-shockwave-flash"
-			src = get_absolute_url(src)
+			src = get_absolute_url(src, base_url)
 			result["src"] = src
 			if width:
 				result["width"] = width
@@ -241,7 +1393,7 @@ def tugua_analyze(tag_src, soup_tmpl, stop_func=None, search_sibling = True):
 					if name == "movie" or name == "src":
 						src = value
 			assert src, "Tag Error!\n  Invalid image url in '{}'.".format(tag)
-			src = get_absolute_url(src)
+			src = get_absolute_url(src, base_url)
 			result = soup_tmpl.new_tag("img")
 			result["alt"] = ""
 			result["src"] = src
@@ -250,73 +1402,23 @@ def tugua_analyze(tag_src, soup_tmpl, stop_func=None, search_sibling = True):
 			logger.warning("Unrecognized object '{}' in '{}'.".format(tag["type"], tag))
 			return None
 	
-	def convert_para(tag):
-		assert isinstance(tag, Tag) and (tag.name == "div" or tag.name == "p"), "Tag Error!\n  Expect 'div' or 'p' but actual is '{}'.".format(tag)
-		result = tag_convert(tag, ignore_root = True)
-		if result:
-			result.name = "p"
-		return result
-	
-	def convert_br(tag):
-		assert isinstance(tag, Tag) and tag.name == "br", "Tag Error!\n  Expect 'br' but actual is '{}'.".format(tag)
-		if tag.contents:
-			result = tag_convert(tag, ignore_root = True)
-			assert not result.contents, "Tag 'br' should have no contents."
-		return soup_tmpl.new_tag("br")
-	
 	def convert_img(tag):
 		assert isinstance(tag, Tag) and tag.name == "img", "Tag Error!\n  Expect 'img' but actual is '{}'.".format(tag)
 		src = tag.get("data-src") or tag.get("data-original") or tag.get("src")
 		assert src, "Tag Error!\n  Invalid image url in '{}'.".format(tag)
 		if src.lower().startswith("file://"):
 			return None
-		src = get_absolute_url(src)
+		src = get_absolute_url(src, base_url)
 		result = soup_tmpl.new_tag("img")
 		result["alt"] = ""
 		result["src"] = src
 		return result
 	
-	def convert_link(tag):
-		assert isinstance(tag, Tag) and tag.name == "a", "Tag Error!\n  Expect 'a' but actual is '{}'.".format(tag)
-		href = tag.get("href")
-		result = tag_convert(tag, ignore_root = True)
-		if href and result:
-			href = get_absolute_url(href)
-			result.name = "a"
-			result["href"] = href
-		else:
-			logger.warning("Unrecognized link in '{}'.".format(tag))
-		return result
-	
-	def convert_table(tag):
-		assert isinstance(tag, Tag) and tag.name == "table", "Tag Error!\n  Expect 'table' but actual is '{}'.".format(tag)
-		result = soup_tmpl.new_tag("table")
-		caption = None
-		for child in list(tag.contents):
-			if not isinstance(child, Tag):
-				continue
-			elif child.name == "caption":
-				caption = tag_convert(child, ignore_root = True)
-				caption.name = child.name
-			elif child.name == "tr":
-				row = soup_tmpl.new_tag("tr")
-				for ch in list(child.contents):
-					if not isinstance(ch, Tag):
-						continue
-					if ch.name == "th" or ch.name == "td":
-						item = tag_convert(ch, ignore_root = True)
-						item.name = ch.name
-						row.append(item)
-				result.append(row)
-		if caption:
-			result.insert(0, caption)
-		return result
-	
 	def convert_frame(tag):
 		assert isinstance(tag, Tag) and tag.name == "iframe", "Tag Error!\n  Expect 'iframe' but actual is '{}'.".format(tag)
 		(width, height) = get_obj_size(tag)
 		src = tag.get("data-src") or tag.get("data-original") or tag.get("src")
-		if re.match(config["SOURCECONF"]["IframeSrcRegex"], src):
+		if runtime.iframe_src_regex.match(src):
 			result = soup_tmpl.new_tag("embed")
 			result["type"] = "application/x-shockwave-flash"
 			result["src"] = src
@@ -327,9 +1429,9 @@ def tugua_analyze(tag_src, soup_tmpl, stop_func=None, search_sibling = True):
 			result["allowFullScreen"] = "true"
 			return result
 		elif src:
-			src = get_absolute_url(src)
+			src = get_absolute_url(src, base_url)
 			logger.error("Frame '{}' converted into link.".format(src))
-			if config["CORRECTION"].getboolean("PromptOnUnsure"):
+			if runtime.prompt_on_unsure:
 				input("Continue? ")
 			result = soup_tmpl.new_tag("a")
 			result["href"] = src
@@ -351,50 +1453,122 @@ def tugua_analyze(tag_src, soup_tmpl, stop_func=None, search_sibling = True):
 	convert_map = {
 		"object": convert_object,
 		"embed": convert_object,
-		"div": convert_para,
-		"p": convert_para,
-		"br": convert_br,
 		"img": convert_img,
-		"a": convert_link,
-		"table": convert_table,
 		"iframe": convert_frame,
 	}
 	
-	def tag_convert(tag, ignore_root = False):
-		nonlocal tag_start
-		nonlocal tag_stop
-		if not tag_start == tag and not tag_start in tag.parents and stop_func and stop_func(tag):
-			tag_stop = tag
-			return None
-		if isinstance(tag, Comment):
-			return None
-		elif isinstance(tag, NavigableString):
-			return convert_str(tag)
-		elif not ignore_root and tag.name in convert_map:
-			return convert_map[tag.name](tag)
-		else:
-			result = soup_tmpl.new_tag("")
-			for child in list(tag.contents):
-				dest = tag_convert(child)
-				if dest:
-					if isinstance(dest, Tag) and dest.name == "":
-						for ch in list(dest.contents):
-							result.append(ch)
-					else:
-						result.append(dest)
-				if tag_stop:
-					break
-			return result
+	def tag_convert(tag):
+		'''\
+		Convert [tag] and its descendants into tag_dest, walking the source tree once with an explicit stack.
+		Paragraphs, links, tables and br are converted into new containers, while other tags are flattened by writing their children into the current container directly.
+		stop_func does not apply to tag_start and its descendants, which is tracked while walking down instead of searching parents.
+		'''
+		stack = []
+		
+		def push(items, handler, done=None, breakable=True):
+			# frame: items to visit, handler for each item, callback when finished, whether to break on stop, whether an item is visited
+			stack.append([iter(items), handler, done, breakable, False])
+		
+		def visit(node, out, inside):
+			nonlocal tag_stop
+			# same as "tag_start == node or tag_start in node.parents", note that bs4 compares tags by contents
+			inside = inside or tag_start == node
+			if not inside and stop_func and stop_func(node):
+				tag_stop = node
+				return
+			if isinstance(node, Comment):
+				return
+			elif isinstance(node, NavigableString):
+				result = convert_str(node)
+				if result:
+					out.append(result)
+				return
+			name = node.name
+			if name in convert_map:
+				result = convert_map[name](node)
+				if result:
+					out.append(result)
+			elif name == "div" or name == "p":
+				result = soup_tmpl.new_tag("p")
+				out.append(result)
+				push(node.contents, lambda child: visit(child, result, inside))
+			elif name == "a":
+				href = node.get("href")
+				if href:
+					result = soup_tmpl.new_tag("a")
+					result["href"] = get_absolute_url(href, base_url)
+					out.append(result)
+					push(node.contents, lambda child: visit(child, result, inside))
+				else:
+					push(node.contents, lambda child: visit(child, out, inside), done=lambda: logger.warning("Unrecognized link in '{}'.".format(node)))
+			elif name == "br":
+				if node.contents:
+					result = soup_tmpl.new_tag("")
+					def check_br():
+						assert not result.contents, "Tag 'br' should have no contents."
+						out.append(soup_tmpl.new_tag("br"))
+					push(node.contents, lambda child: visit(child, result, inside), done=check_br)
+				else:
+					out.append(soup_tmpl.new_tag("br"))
+			elif name == "table":
+				visit_table(node, out, inside)
+			else:
+				push(node.contents, lambda child: visit(child, out, inside))
+		
+		def visit_table(node, out, inside):
+			result = soup_tmpl.new_tag("table")
+			out.append(result)
+			caption = None
+			def cells():
+				for child in node.contents:
+					if not isinstance(child, Tag):
+						continue
+					elif child.name == "caption":
+						yield (child, None)
+					elif child.name == "tr":
+						row = soup_tmpl.new_tag("tr")
+						result.append(row)
+						for ch in child.contents:
+							if isinstance(ch, Tag) and (ch.name == "th" or ch.name == "td"):
+								yield (ch, row)
+			def visit_cell(cell):
+				nonlocal tag_stop
+				nonlocal caption
+				(child, row) = cell
+				child_inside = inside or tag_start == child
+				if not child_inside and stop_func and stop_func(child):
+					tag_stop = child
+					return
+				item = soup_tmpl.new_tag(child.name)
+				if row is None:
+					caption = item
+				else:
+					row.append(item)
+				push(child.contents, lambda ch: visit(ch, item, child_inside))
+			def insert_caption():
+				if caption:
+					result.insert(0, caption)
+			# cells are always converted even after stopped
+			push(cells(), visit_cell, done=insert_caption, breakable=False)
+		
+		visit(tag, tag_dest, False)
+		while stack:
+			frame = stack[-1]
+			(items, handler, done, breakable, visited) = frame
+			item = None
+			if not (visited and breakable and tag_stop):
+				item = next(items, None)
+			if item is None:
+				stack.pop()
+				if done:
+					done()
+				continue
+			frame[4] = True
+			handler(item)
 	
 	tag_dest = soup_tmpl.new_tag("div")
 	while tag_src:
-		tag_new = tag_convert(tag_src)
-		if tag_new:
-			if isinstance(tag_new, Tag) and tag_new.name == "":
-				for child in list(tag_new.contents):
-					tag_dest.append(child)
-			else:
-				tag_dest.append(tag_new)
+		tag_convert(tag_src)
 		if not search_sibling or tag_stop:
 			break
 		while not tag_src.next_sibling and tag_src.parent:
@@ -402,20 +1576,17 @@ def tugua_analyze(tag_src, soup_tmpl, stop_func=None, search_sibling = True):
 		tag_src = tag_src.next_sibling
 	return (tag_dest, tag_stop)
 
-def tugua_format(tag_src, soup_tmpl, img_dir="", img_info={}, section_id="", has_subtitle=False):
+def tugua_format(tag_src, soup_tmpl, img_dir="", img_info={}, section_id="", has_subtitle=False, down_img=True, runtime=None):
 	'''\
 	Format tugua node [tag_src:bs4.element.Tag] to a simple style, with div section [section_id:str] and title when [has_subtitle:bool] is True.
-	It also downloads images into [img_dir:str] and renames with "[section_id]_%img_info['count']%.%ext%" or "face_%count%.%ext%", and to avoid duplicated face image, the url of face image will be stored in [img_info:dict].
+	It also downloads images into [img_dir:str] by "tugua_images" when [down_img:bool] is True, see it for [img_info:dict].
 	It returns a new node with soup template [soup_tmpl:bs4.BeautifulSoup].
 	Return: bs4.element.Tag
 	'''
+	runtime = runtime or get_runtime()
 	dest = soup_tmpl.new_tag("div")
 	if section_id:
 		dest["id"] = section_id
-	ext_regex = re.compile(r"^data:image/(\w+);|\.(\w+)$|\.(\w+)\?")
-	img_format_map = {
-		"jpeg": "jpg"
-	}
 	last_string = ""
 	last_para = soup_tmpl.new_tag("p")
 	def complete_last_string():
@@ -434,6 +1605,8 @@ def tugua_format(tag_src, soup_tmpl, img_dir="", img_info={}, section_id="", has
 	
 	if not tag_src.contents:
 		return dest
+	if down_img and runtime.download_img:
+		tugua_images([(section_id, tag_src)], img_dir, img_info, runtime=runtime)
 	for tag in list(tag_src.contents):
 		if isinstance(tag, NavigableString):
 			last_string += tag.strip()
@@ -441,85 +1614,18 @@ def tugua_format(tag_src, soup_tmpl, img_dir="", img_info={}, section_id="", has
 			complete_last_para()
 			dest.append(tag.wrap(soup_tmpl.new_tag("p")))
 		elif tag.name == "img":
-			if not config["TUGUA"].getboolean("DownloadImg"):
-				complete_last_string()
-				last_para.append(tag)
-			elif tag["src"] in img_info:
-				tag["src"] = img_info[tag["src"]]
-				tag["class"] = config["IDENT"]["Face"]
+			if runtime.download_img and tag.get("class") != runtime.face_ident:
+				complete_last_para()
+				dest.append(tag.wrap(soup_tmpl.new_tag("p")))
+			else:
 				complete_last_string()
 				last_para.append(tag)
-			else:
-				ext_match = ext_regex.search(tag["src"])
-				if ext_match:
-					ext = ext_match.group(1) or ext_match.group(2) or ext_match.group(3)
-				else:
-					logger.warning("No extension found for image '{}', default to '{}'.".format(tag["src"], config["CORRECTION"]["DefaultImgExt"]))
-					ext = config["CORRECTION"]["DefaultImgExt"]
-				ext = ext.lower()
-				if ext in img_format_map:
-					ext = img_format_map[ext]
-				img_path = os.path.join(img_dir, "{}_{:02}.{}".format(section_id, img_info["count"]+1, ext))
-				url = tag["src"].strip()
-				if url.startswith("file:"):
-					logger.warning("Illegal image url '{}', ignored.".format(url))
-				else:
-					ret = down_url(url, img_path)
-					if not ret:
-						input("Continue? ")
-					is_face = False
-					if ret:
-						try:
-							img = Image.open(img_path)
-							format = img.format
-							(img_width, img_height) = img.size
-							is_face = img_width <= config["CORRECTION"].getint("FaceImgWidthMax") and img_height <= config["CORRECTION"].getint("FaceImgHeightMax")
-							del img
-							if format:
-								format = format.lower()
-							if format in img_format_map:
-								format = img_format_map[format]
-							if not format:
-								logger.error("Can't recognize the format of image '{}'.".format(img_path))
-								if config["CORRECTION"].getboolean("PromptOnUnsure"):
-									input("Continue? ")
-							if format != ext:
-								new_img_path = os.path.join(img_dir, "{}_{:02}.{}".format(section_id, img_info["count"]+1, format))
-								logger.error("Image format mismatch, Renaming '{}' to '{}'.".format(img_path, new_img_path))
-								if config["CORRECTION"].getboolean("PromptOnUnsure"):
-									input("Continue? ")
-								if os.path.isfile(new_img_path):
-									os.remove(new_img_path)
-								os.rename(img_path, new_img_path)
-								ext = format
-								img_path = new_img_path
-						except OSError:
-							logger.error("Can't recognize image file '{}', default to non-face image.".format(img_path))
-							is_face = False
-							input("Continue? ")
-					if is_face:
-						new_img_path = os.path.join(img_dir, "{}_{:02}.{}".format(config["IDENT"]["Face"], len(img_info), ext))
-						logger.info("Face image found, Renaming '{}' to '{}'.".format(img_path, new_img_path))
-						if os.path.isfile(new_img_path):
-							os.remove(new_img_path)
-						os.rename(img_path, new_img_path)
-						img_path = new_img_path
-						img_info[tag["src"]] = img_path
-						tag["src"] = img_path
-						tag["class"] = config["IDENT"]["Face"]
-						complete_last_string()
-						last_para.append(tag)
-					else:
-						img_info["count"] += 1
-						tag["src"] = img_path
-						complete_last_para()
-						dest.append(tag.wrap(soup_tmpl.new_tag("p")))
 		elif tag.name == "a":
-			temp = tugua_format(tag, soup_tmpl, img_dir=img_dir, img_info=img_info, section_id=section_id)
+			temp = tugua_format(tag, soup_tmpl, img_dir=img_dir, img_info=img_info, section_id=section_id, down_img=False, runtime=runtime)
 			link_contents = []
 			for child in list(temp.contents):
 				for ch in child.contents:
-					if isinstance(ch, NavigableString) or (isinstance(ch, Tag) and ch.name == "img" and ch["src"].startswith(config["IDENT"]["Face"])):
+					if isinstance(ch, NavigableString) or (isinstance(ch, Tag) and ch.name == "img" and (ch["src"].startswith(runtime.face_ident) or ch.get("class") == runtime.face_ident)):
 						link_contents.append(ch)
 					else:
 						if link_contents:
@@ -545,7 +1651,7 @@ def tugua_format(tag_src, soup_tmpl, img_dir="", img_info={}, section_id="", has
 					link_contents = []
 		elif tag.name == "p":
 			complete_last_para()
-			temp = tugua_format(tag, soup_tmpl, img_dir=img_dir, img_info=img_info, section_id=section_id)
+			temp = tugua_format(tag, soup_tmpl, img_dir=img_dir, img_info=img_info, section_id=section_id, down_img=False, runtime=runtime)
 			for child in list(temp.contents):
 				dest.append(child)
 		elif tag.name == "br":
@@ -560,70 +1666,341 @@ def tugua_format(tag_src, soup_tmpl, img_dir="", img_info={}, section_id="", has
 		dest["class"] = config["IDENT"]["Section"]
 	return dest
 
-def tugua_srchook(url, data):
-	def hook_replace(data, args):
-		pair = args.split("->")
-		assert len(pair) == 2, "Config Error!\n  Invalid source hook arguments '{}'.".format(args)
-		return data.replace(pair[0].strip().encode(encoding="UTF-8"), pair[1].strip().encode(encoding="UTF-8"))
-	def hook_regex(data, args):
-		pair = args.split("->")
-		assert len(pair) == 2, "Config Error!\n  Invalid source hook arguments '{}'.".format(args)
-		return re.sub(pair[0].strip().encode(encoding="UTF-8"), pair[1].strip().encode(encoding="UTF-8"), data)
+def hook_replace(data, args):
+	return data.replace(args[0], args[1])
 
-	hook_map = {
-		"replace": hook_replace,
-		"regex": hook_regex,
-	}
-	for key, args in config["SOURCEHOOK"].items():
-		pair = key.split("@")
-		assert len(pair) == 2, "Config Error!\n  Invalid source hook key '{}'.".format(key)
-		if pair[0].strip().lower() in url.lower():
-			hook_func = hook_map.get(pair[1].strip())
-			assert hook_func, "Config Error!\n  Invalid source hook key '{}'.".format(key)
+def hook_regex(data, args):
+	return args[0].sub(args[1], data)
+
+def tugua_srchook(url, data, runtime=None):
+	'''\
+	Apply "SOURCEHOOK" rules matching [url:str] to the downloaded source [data:bytes].
+	Return: bytes
+	'''
+	runtime = runtime or get_runtime()
+	for (site, key, hook_func, args) in runtime.src_hooks:
+		if site in url.lower():
 			logger.info("Applying hook to '{}' using '{}' ...".format(url, key))
 			data = hook_func(data, args)
 	return data
 
-def tugua_download(url, directory="", date=None, orig_url=None):
+class Journal(object):
 	'''\
-	Download tugua of [date:datetime|str] from [url:str], and store into [directory:str].
-	It will create a new folder named "YYYYmmdd" and store converted file into it, and store the original html file into "src" folder.
-	Return: None
+	Job journal of tugua dates in a SQLite database, so that an interrupted date can resume with its face image names.
+	Every saved image is recorded by one small transaction as a (date, url, name, face) row, and resuming reads rows of that date only.
+	Rows are kept after a date is finished as the manifest of its images, until the date is converted again.
+	Pages and images failed in non-interactive mode are queued in it for "tugua_retry".
 	'''
-	head_regex = re.compile(config["SOURCECONF"]["HeadRegex"])
-	tail_regex = re.compile(config["SOURCECONF"]["TailRegex"])
-	epi_regex = re.compile(config["SOURCECONF"]["EpilogueRegex"])
-	# prepare source directory
-	if not date:
-		date = datetime.date.today()
-	if isinstance(date, datetime.date):
-		date_str = date.strftime("%Y%m%d")
-	else:
-		date_str = date
-	directory = os.path.realpath(os.path.abspath(directory))
-	src_dir = os.path.join(directory, config["TUGUA"]["SrcDir"])
-	if not os.path.isdir(src_dir):
-		os.makedirs(src_dir)
-	src_path = os.path.join(src_dir, date_str + ".html")
-	# download contents
-	global urlsrc
-	url = url.strip()
-	urlsrc = url
-	if not down_url(url, src_path, referer="", hook=tugua_srchook):
-		input("Continue? ")
-	data = None
-	with open(src_path, "rb") as src_file:
-		data = src_file.read()
-	src = parse_html(data)
-	dest = BeautifulSoup("", config["TUGUA"]["HtmlParser"])
-	# analyze source title and frame
-	title_tag_src = src.find("title")
-	assert title_tag_src, "No title found!"
-	title = title_tag_src.get_text()
-	title_match = re.search(r"【喷嚏图卦(\d{8})】\S.*$", title)
-	assert title_match, "No title found!\n  Title tag is '{}'.".format(title)
-	assert date_str == title_match.group(1), "Date mismatch!\n  Input is '{}', actual is '{}'.".format(date_str, title_match.group(1))
-	title = title_match.group(0).strip()
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.execute("PRAGMA synchronous=NORMAL")
+		with self.conn:
+			self.conn.execute("CREATE TABLE IF NOT EXISTS dates (date TEXT PRIMARY KEY, done INTEGER NOT NULL DEFAULT 0, url TEXT, orig_url TEXT)")
+			# journals created before urls were recorded
+			columns = [row[1] for row in self.conn.execute("PRAGMA table_info(dates)")]
+			for column in ("url", "orig_url"):
+				if column not in columns:
+					self.conn.execute("ALTER TABLE dates ADD COLUMN {} TEXT".format(column))
+			self.conn.execute("CREATE TABLE IF NOT EXISTS images (date TEXT NOT NULL, url TEXT NOT NULL, name TEXT NOT NULL, face INTEGER NOT NULL, PRIMARY KEY (date, url))")
+			self.conn.execute("CREATE TABLE IF NOT EXISTS failures (date TEXT NOT NULL, kind TEXT NOT NULL, url TEXT NOT NULL, name TEXT NOT NULL, reason TEXT NOT NULL, tries INTEGER NOT NULL, time TEXT NOT NULL, PRIMARY KEY (date, kind, url))")
+	
+	def begin(self, date_str, clear_failures=True):
+		'''\
+		Start converting [date_str:str], records of a finished run are cleared first.
+		Queued image failures are cleared too if [clear_failures:bool], since they are found again when images are downloaded, but not when converting offline.
+		Return: dict(str:str) - face image names by url recorded by the unfinished run
+		'''
+		with self.lock, self.conn:
+			row = self.conn.execute("SELECT done FROM dates WHERE date = ?", (date_str,)).fetchone()
+			if row and row[0]:
+				self.conn.execute("DELETE FROM images WHERE date = ?", (date_str,))
+			if clear_failures:
+				self.conn.execute("DELETE FROM failures WHERE date = ? AND kind = 'image'", (date_str,))
+			self.conn.execute("INSERT INTO dates (date, done) VALUES (?, 0) ON CONFLICT (date) DO UPDATE SET done = 0", (date_str,))
+			rows = self.conn.execute("SELECT url, name FROM images WHERE date = ? AND face = 1", (date_str,)).fetchall()
+		return dict(rows)
+	
+	def record(self, date_str, url, name, is_face):
+		'''\
+		Record image [url:str] of [date_str:str] saved as [name:str], [is_face:bool] tells whether it is a face image.
+		Return: None
+		'''
+		with self.lock, self.conn:
+			self.conn.execute("INSERT OR REPLACE INTO images (date, url, name, face) VALUES (?, ?, ?, ?)", (date_str, url, name, int(is_face)))
+	
+	def finish(self, date_str):
+		with self.lock, self.conn:
+			self.conn.execute("UPDATE dates SET done = 1 WHERE date = ?", (date_str,))
+			self.conn.execute("DELETE FROM failures WHERE date = ? AND kind = 'page'", (date_str,))
+	
+	def fail(self, date_str, kind, url, name, reason):
+		'''\
+		Queue failed [kind:str] item, "page" or "image", of [url:str] for [date_str:str], with file [name:str] and [reason:str].
+		Tries are counted if it is queued already.
+		Return: None
+		'''
+		now = datetime.datetime.now().isoformat(timespec="seconds")
+		with self.lock, self.conn:
+			self.conn.execute("INSERT INTO failures (date, kind, url, name, reason, tries, time) VALUES (?, ?, ?, ?, ?, 1, ?) "
+				"ON CONFLICT (date, kind, url) DO UPDATE SET name = excluded.name, reason = excluded.reason, tries = tries + 1, time = excluded.time",
+				(date_str, kind, url, name, reason, now))
+	
+	def failures(self):
+		'''\
+		Get all queued failures, ordered by date.
+		Return: list((str, str, str, str, str, int)) - date, kind, url, name, reason and tries
+		'''
+		with self.lock:
+			return self.conn.execute("SELECT date, kind, url, name, reason, tries FROM failures ORDER BY date, kind, name").fetchall()
+	
+	def resolve(self, date_str, kind, url):
+		with self.lock, self.conn:
+			self.conn.execute("DELETE FROM failures WHERE date = ? AND kind = ? AND url = ?", (date_str, kind, url))
+	
+	def store_urls(self, date_str, url, orig_url):
+		'''\
+		Record page [url:str] of [date_str:str] and its original page [orig_url:str], so that converting it again without them keeps the links.
+		Return: None
+		'''
+		with self.lock, self.conn:
+			self.conn.execute("INSERT INTO dates (date, url, orig_url) VALUES (?, ?, ?) ON CONFLICT (date) DO UPDATE SET url = excluded.url, orig_url = excluded.orig_url", (date_str, url, orig_url))
+	
+	def urls(self, date_str):
+		'''\
+		Get page url and original page url recorded for [date_str:str].
+		Return: (str, str) - both None if not recorded
+		'''
+		with self.lock:
+			row = self.conn.execute("SELECT url, orig_url FROM dates WHERE date = ?", (date_str,)).fetchone()
+		return (row[0], row[1]) if row else (None, None)
+	
+	def unfinished(self):
+		'''\
+		Get dates started but not finished yet.
+		Return: set(str)
+		'''
+		with self.lock:
+			rows = self.conn.execute("SELECT date FROM dates WHERE done = 0").fetchall()
+		return {row[0] for row in rows}
+	
+	def manifest(self, date_str):
+		'''\
+		Get images recorded for [date_str:str].
+		Return: dict(str:(str, bool)) - image name and whether it is a face by url
+		'''
+		with self.lock:
+			rows = self.conn.execute("SELECT url, name, face FROM images WHERE date = ?", (date_str,)).fetchall()
+		return {url: (name, bool(face)) for (url, name, face) in rows}
+	
+	def import_pickle(self, tmp_path):
+		'''\
+		Import unfinished dates from the pickled record file [tmp_path:str] used before, and remove it.
+		Return: None
+		'''
+		if not os.path.isfile(tmp_path):
+			return
+		if os.path.getsize(tmp_path) > 0:
+			with open(tmp_path, "rb") as tmp_file:
+				tmp_data = pickle.loads(tmp_file.read())
+			with self.lock, self.conn:
+				for (date_str, img_info) in tmp_data.items():
+					self.conn.execute("INSERT INTO dates (date, done) VALUES (?, 0) ON CONFLICT (date) DO UPDATE SET done = 0", (date_str,))
+					for (url, name) in img_info.items():
+						if url != "count":
+							self.conn.execute("INSERT OR REPLACE INTO images (date, url, name, face) VALUES (?, ?, ?, 1)", (date_str, url, name))
+			logger.info("Imported {} unfinished dates from '{}'.".format(len(tmp_data), tmp_path))
+		try:
+			os.remove(tmp_path)
+		except FileNotFoundError:
+			# imported by another process meanwhile
+			pass
+	
+	def close(self):
+		with self.lock:
+			self.conn.close()
+
+def get_journal(src_dir):
+	'''\
+	Get the job journal under source [src_dir:str], configured by "JournalFile", old "TmpFile" records are imported on first use.
+	Return: Journal
+	'''
+	global journal
+	path = os.path.join(src_dir, config["TUGUA"]["JournalFile"])
+	with global_lock:
+		if journal is None or journal.path != path:
+			if journal is not None:
+				journal.close()
+			journal = Journal(path)
+			journal.import_pickle(os.path.join(src_dir, config["TUGUA"]["TmpFile"]))
+	return journal
+
+def close_journal():
+	global journal
+	if journal is not None:
+		journal.close()
+		journal = None
+
+class SearchIndex(object):
+	'''\
+	Full-text index of converted sections, stored under [search_dir] as shards for "searchTugua" in tugua.js.
+	Each date writes its own postings into "dates/YYYYmmdd.json" by "add", so that dates converted by several processes do not conflict, and "merge" folds changed dates into the shards later.
+	Tokens are bigrams of CJK characters and lowercase alphanumeric words, documents are sections numbered as YYYYmmddNN, and tokens are sharded by "token_hash".
+	Shards are JSON wrapped by a "tuguaSearchLoad" call, so that static pages can load them by script tags even from local disk.
+	'''
+	shard_count = 64
+	token_regex = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[0-9a-z]+")
+	
+	def __init__(self, search_dir):
+		self.search_dir = search_dir
+	
+	@classmethod
+	def tokens(cls, text):
+		'''\
+		Split [text:str] into search tokens, the same as "searchTokens" in tugua.js.
+		Return: set(str)
+		'''
+		tokens = set()
+		for match in cls.token_regex.finditer(text.lower()):
+			word = match.group(0)
+			if word[0] < "\u0080":
+				if len(word) > 1:
+					tokens.add(word)
+			else:
+				tokens.update(word[index:index+2] for index in range(len(word) - 1))
+		return tokens
+	
+	@staticmethod
+	def token_hash(token):
+		'''\
+		Hash [token:str] like "searchHash" in tugua.js, tokens only contain BMP characters so code points are the same as UTF-16 units.
+		Return: int
+		'''
+		value = 0
+		for char in token:
+			value = (value * 31 + ord(char)) & 0xFFFFFFFF
+		return value
+	
+	def path(self, name, ext=".js"):
+		return os.path.join(self.search_dir, *name.split("/")) + ext
+	
+	def load(self, name):
+		path = self.path(name)
+		if not os.path.isfile(path):
+			return {}
+		with open(path, "r", encoding="UTF-8") as js_file:
+			text = js_file.read()
+		return json.loads(text[text.index(",") + 1:text.rindex(")")])
+	
+	def store(self, name, data, ext=".js"):
+		'''\
+		Replace file of [name:str] with [data], atomically so that pages never load a partial shard.
+		Return: None
+		'''
+		path = self.path(name, ext)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		text = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+		if ext == ".js":
+			text = "tuguaSearchLoad({},{});\n".format(json.dumps(name), text)
+		with open(path + ".tmp", "w", encoding="UTF-8") as tmp_file:
+			tmp_file.write(text)
+		os.replace(path + ".tmp", path)
+	
+	def add(self, date_str, sections):
+		'''\
+		Write postings of converted [sections:list(bs4.element.Tag)] of [date_str:str], replacing those written before.
+		Return: None
+		'''
+		docs = {}
+		postings = {}
+		for (index, section) in enumerate(sections):
+			doc = int(date_str) * 100 + index + 1
+			docs[doc] = section.contents[0].get_text(" ").strip() if section.contents else ""
+			for token in self.tokens(section.get_text(" ")):
+				postings.setdefault(token, []).append(doc)
+		self.store("dates/" + date_str, {"docs": docs, "tokens": postings}, ext=".json")
+	
+	def merge(self):
+		'''\
+		Fold dates added or changed since the last merge into the shards, postings of dates changed are purged from all shards first.
+		Return: int - how many dates merged
+		'''
+		state_path = self.path("state", ".json")
+		state = {"shards": self.shard_count, "dates": {}}
+		if os.path.isfile(state_path):
+			with open(state_path, "r", encoding="UTF-8") as state_file:
+				state = json.load(state_file)
+		if state["shards"] != self.shard_count:
+			state = {"shards": self.shard_count, "dates": {}}
+		dates_dir = os.path.join(self.search_dir, "dates")
+		dates = {}
+		if os.path.isdir(dates_dir):
+			for name in os.listdir(dates_dir):
+				if re.match(r"^\d{8}\.json$", name):
+					dates[name[:8]] = os.path.getmtime(os.path.join(dates_dir, name))
+		changed = sorted(date_str for (date_str, mtime) in dates.items() if state["dates"].get(date_str) != mtime)
+		purged = set(date_str for date_str in state["dates"] if date_str not in dates or date_str in changed)
+		if not changed and not purged:
+			return 0
+		shards = {}
+		months = {}
+		def get_shard(number):
+			if number not in shards:
+				shards[number] = self.load("index/{:02x}".format(number))
+			return shards[number]
+		def get_month(month):
+			if month not in months:
+				months[month] = self.load("docs/" + month)
+			return months[month]
+		if purged:
+			for number in range(self.shard_count):
+				shard = get_shard(number)
+				for token in list(shard):
+					shard[token] = [doc for doc in shard[token] if str(doc)[:8] not in purged]
+					if not shard[token]:
+						del shard[token]
+			for date_str in purged:
+				docs = get_month(date_str[:6])
+				for doc in [doc for doc in docs if doc[:8] == date_str]:
+					del docs[doc]
+				state["dates"].pop(date_str, None)
+		for date_str in changed:
+			with open(os.path.join(dates_dir, date_str + ".json"), "r", encoding="UTF-8") as date_file:
+				data = json.load(date_file)
+			get_month(date_str[:6]).update(data["docs"])
+			for (token, docs) in data["tokens"].items():
+				shard = get_shard(self.token_hash(token) % self.shard_count)
+				shard[token] = sorted(set(shard.get(token, [])) | set(docs))
+			state["dates"][date_str] = dates[date_str]
+		for (number, shard) in shards.items():
+			self.store("index/{:02x}".format(number), shard)
+		for (month, docs) in months.items():
+			self.store("docs/" + month, docs)
+		self.store("meta", {"shards": self.shard_count})
+		self.store("state", state, ext=".json")
+		logger.info("Search index merged {} dates, purged {} dates.".format(len(changed), len(purged)))
+		return len(changed)
+
+def get_search(directory):
+	'''\
+	Get the search index under tugua [directory:str], configured by "SearchDir".
+	Return: SearchIndex - None if disabled
+	'''
+	if not config["TUGUA"]["SearchDir"]:
+		return None
+	return SearchIndex(os.path.join(directory, config["TUGUA"]["SearchDir"]))
+
+def tugua_split(src, soup_tmpl, base_url=None, runtime=None):
+	'''\
+	Find the content of tugua page [src:BeautifulSoup], then analyze it into prologue and sections with tags created from [soup_tmpl:BeautifulSoup].
+	Return: (Tag, list(Tag)) - prologue and sections
+	'''
+	runtime = runtime or get_runtime()
+	head_regex = runtime.head_regex
+	tail_regex = runtime.tail_regex
 	start_tag_src = src.find(text=head_regex)
 	if start_tag_src:
 		while not start_tag_src.name or start_tag_src.name == "a":
@@ -639,28 +2016,7 @@ def tugua_download(url, directory="", date=None, orig_url=None):
 			tmp_tag = tmp_tag.next_sibling
 	assert start_tag_src and end_tag_src, "No content found!\n  Start is '{}', end is '{}'.".format(start_tag_src, end_tag_src)
 	if not end_tag_src.next_element:
-		src.append(dest.new_tag("end"))
-	# construct dest frame
-	dest.append(dest.new_tag("html"))
-	head_tag_dest = dest.new_tag("head")
-	charset_tag = dest.new_tag("meta")
-	charset_tag["http-equiv"] = "Content-Type"
-	charset_tag["content"] = "text/html; charset={}".format(config["TUGUA"]["DestEncoding"])
-	head_tag_dest.append(charset_tag)
-	if config["STYLE"]["JqueryFile"]:
-		head_tag_dest.append(dest.new_tag("script", type="text/javascript", src=config["STYLE"]["JqueryFile"]))
-	if config["STYLE"]["CssFile"]:
-		head_tag_dest.append(dest.new_tag("link", rel="stylesheet", type="text/css", href=config["STYLE"]["CssFile"]))
-	if config["STYLE"]["JsFile"]:
-		head_tag_dest.append(dest.new_tag("script", type="text/javascript", src=config["STYLE"]["JsFile"]))
-	title_tag_dest = dest.new_tag("title")
-	title_tag_dest.string = title
-	head_tag_dest.append(title_tag_dest)
-	dest.html.append(head_tag_dest)
-	body_tag_dest = dest.new_tag("body")
-	dest.html.append(body_tag_dest)
-	# analyze and convert
-	subtitle_regex = re.compile(r"^【(\d{0,2})】(.*)")
+		src.append(soup_tmpl.new_tag("end"))
 	def stop_func(tag):
 		if tag == end_tag_src:
 			return True
@@ -670,18 +2026,205 @@ def tugua_download(url, directory="", date=None, orig_url=None):
 			return True
 		else:
 			return False
-	(prologue, curr_src) = tugua_analyze(start_tag_src, dest, stop_func=stop_func)
+	(prologue, curr_src) = tugua_analyze(start_tag_src, soup_tmpl, stop_func=stop_func, base_url=base_url, runtime=runtime)
 	sections = []
 	while True:
 		assert curr_src, "Unsupported Error!\n  Analysis tag suspended."
-		(section, curr_src) = tugua_analyze(curr_src, dest, stop_func=stop_func)
+		(section, curr_src) = tugua_analyze(curr_src, soup_tmpl, stop_func=stop_func, base_url=base_url, runtime=runtime)
 		sections.append(section)
 		if curr_src == end_tag_src:
-			(last_tag, _) = tugua_analyze(curr_src, dest, search_sibling=False)
+			(last_tag, _) = tugua_analyze(curr_src, soup_tmpl, search_sibling=False, base_url=base_url, runtime=runtime)
 			if last_tag.name == "div":
 				last_tag.name = "p"
 			section.append(last_tag)  # a bit tricky, append it into previous section
 			break
+	return (prologue, sections)
+
+def tugua_inline_images(nodes, directory, stats=None, runtime=None):
+	'''\
+	Move images of data urls under [nodes:list(bs4.element.Tag)] out of the page into "InlineDir" under tugua [directory:str].
+	Each image is decoded without urllib and stored once as "[sha1].[ext]" shared by all dates, and img tags are pointed to it, with face class if it is a face image.
+	Images externalized are counted into [stats:Metrics] if given.
+	Return: None
+	'''
+	runtime = runtime or get_runtime()
+	inline_dir = os.path.join(directory, config["TUGUA"]["InlineDir"])
+	for node in nodes:
+		for tag in node.find_all("img", src=True):
+			url = tag["src"].strip()
+			data = decode_data_url(url) if url.startswith("data:") else None
+			if not data:
+				continue
+			sniffer = ImgSniffer()
+			if not sniffer.feed(data):
+				logger.warning("Can't recognize image of data url '{}...', keep it inline.".format(url[:40]))
+				continue
+			name = "{}.{}".format(hashlib.sha1(data).hexdigest(), sniffer.format or get_img_ext(url) or runtime.default_img_ext)
+			path = os.path.join(inline_dir, name)
+			if not os.path.isfile(path):
+				if not os.path.isdir(inline_dir):
+					os.makedirs(inline_dir, exist_ok=True)
+				# written aside and renamed, since several dates may save the same image at once
+				tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+				with open(tmp_path, "wb") as img_file:
+					img_file.write(data)
+				os.replace(tmp_path, path)
+			tag["src"] = "../{}/{}".format(config["TUGUA"]["InlineDir"], name)
+			if sniffer.is_face(runtime):
+				tag["class"] = runtime.face_ident
+			if stats:
+				stats.count("inline_images")
+
+def tugua_prewarm(nodes, img_cache=None, runtime=None):
+	'''\
+	Start connecting to image hosts under [nodes:list(bs4.element.Tag)] in background, images already in [img_cache:ImgCache] are left out.
+	Urls are switched like "down_url" does, and each host gets up to "HostConcurrency" connections.
+	Return: None
+	'''
+	runtime = runtime or get_runtime()
+	urls = []
+	for node in nodes:
+		for tag in node.find_all("img", src=True):
+			url = tag["src"].strip()
+			if not url.startswith("data:") and not (img_cache and img_cache.contains(url)):
+				urls.append(switch_url(get_absolute_url(url), runtime=runtime))
+	if urls:
+		get_connpool().prewarm(urls, per_host=max(config["NETWORK"].getint("HostConcurrency"), 1))
+
+def tugua_local_images(img_dir, parts, manifest):
+	'''\
+	Find images converted before into [img_dir:str], for converting [parts:list((str, bs4.element.Tag))] offline by "tugua_images".
+	Files are found by [manifest:dict(str:(str, bool))] recorded in the journal, or by img tags of the old converted page in document order if nothing is recorded.
+	They are not read here, "tugua_images" links each to a temporary file before any image is written, since images may be named differently this time.
+	Return: dict(str:str) - image file path by url
+	'''
+	names = {url.strip(): name for (url, (name, _)) in manifest.items()}
+	if not names:
+		urls = [tag["src"].strip() for (_, tag_src) in parts for tag in tag_src.find_all("img")]
+		urls = [url for url in urls if not url.startswith("file:")]
+		dest_path = os.path.join(img_dir, config["TUGUA"]["DestFile"])
+		if os.path.isfile(dest_path):
+			with open(dest_path, "rb") as dest_file:
+				dest = parse_html(dest_file.read())
+			old_names = [tag.get("src", "") for tag in dest.find_all("img")]
+			if len(old_names) == len(urls):
+				names = dict(zip(urls, old_names))
+			else:
+				logger.warning("Image number mismatch in '{}', expect {} but actual is {}.".format(dest_path, len(urls), len(old_names)))
+	local = {}
+	for (url, name) in names.items():
+		path = os.path.join(img_dir, name)
+		if name and os.path.basename(name) == name and os.path.isfile(path):
+			local[url] = path
+	return local
+
+def tugua_download(url, directory="", date=None, orig_url=None, offline=False, runtime=None):
+	'''\
+	Download tugua of [date:datetime|str] from [url:str], and store into [directory:str].
+	It will create a new folder named "YYYYmmdd" and store converted file into it, and store the original html file into "src" folder.
+	If [url] is empty, the url stored with the source file is used.
+	When [offline:bool] is True, it converts the stored source again with images already on disk, see "tugua_local_images".
+	A date packed into a bundle is unpacked back into its folder first, so that it is converted in place instead of into a new folder beside the bundle, and packed again once converted.
+	Metrics of the date are appended into "MetricsFile" under [directory] whether it succeeds or not, see "Metrics".
+	Return: None
+	'''
+	runtime = runtime or get_runtime()
+	if not date:
+		date = datetime.date.today()
+	if isinstance(date, datetime.date):
+		date_str = date.strftime("%Y%m%d")
+	else:
+		date_str = date
+	metrics = Metrics(date_str, url.strip())
+	metrics_path = os.path.join(os.path.realpath(os.path.abspath(directory)), config["LOG"]["MetricsFile"]) if config["LOG"]["MetricsFile"] else None
+	try:
+		tugua_convert(url, directory, date_str, orig_url, offline, metrics, runtime=runtime)
+	except BaseException as err:
+		if metrics_path:
+			metrics.store(metrics_path, err)
+		raise
+	if metrics_path:
+		metrics.store(metrics_path)
+
+def tugua_link(directory, date_str):
+	'''\
+	Find the link to the original page in the title of the page of [date_str:str] converted under [directory:str], from its intermediate representation, folder or bundle.
+	Return: str - None if not found
+	'''
+	ir_path = os.path.join(directory, config["TUGUA"]["IRDir"], date_str + ".json") if config["TUGUA"]["IRDir"] else None
+	if ir_path and os.path.isfile(ir_path):
+		ir = ir_load(ir_path)
+		if ir and ir.get("link"):
+			return ir["link"]
+	dest_path = os.path.join(directory, date_str, config["TUGUA"]["DestFile"])
+	bundle_path = get_bundle_path(directory, date_str)
+	data = None
+	if os.path.isfile(dest_path):
+		with open(dest_path, "rb") as dest_file:
+			data = dest_file.read()
+	elif bundle_path and os.path.isfile(bundle_path):
+		bundle = Bundle(bundle_path)
+		try:
+			data = bundle.read(config["TUGUA"]["DestFile"])
+		finally:
+			bundle.close()
+	if not data:
+		return None
+	title_tag = parse_html(data).find(id=config["IDENT"]["Title"])
+	link_tag = title_tag.find("a", href=True) if title_tag else None
+	return link_tag["href"] if link_tag and link_tag["href"] else None
+
+def tugua_convert(url, directory, date_str, orig_url, offline, metrics, runtime=None):
+	'''\
+	Download and convert tugua of [date_str:str] for "tugua_download", with time and counters of each stage added into [metrics:Metrics].
+	Return: None
+	'''
+	runtime = runtime or get_runtime()
+	# prepare source directory
+	directory = os.path.realpath(os.path.abspath(directory))
+	src_dir = os.path.join(directory, config["TUGUA"]["SrcDir"])
+	if not os.path.isdir(src_dir):
+		os.makedirs(src_dir)
+	src_path = get_source_path(os.path.join(src_dir, date_str + ".html"))
+	# find urls not given from the journal, the source validator, or the title link of the page converted before urls were recorded
+	record = get_journal(src_dir)
+	(recorded_url, recorded_orig_url) = record.urls(date_str)
+	url = url.strip() or recorded_url or load_validator(src_path).get("url", "")
+	orig_url = orig_url or recorded_orig_url
+	if not recorded_url and not orig_url:
+		link = tugua_link(directory, date_str)
+		if link and url and link != url:
+			orig_url = link
+		url = url or link or ""
+	if url:
+		record.store_urls(date_str, url, orig_url)
+	# download contents
+	if offline:
+		assert os.path.isfile(src_path), "No source found!\n  Source file '{}' does not exist.".format(src_path)
+	elif not down_url(url, src_path, referer="", hook=lambda src_url, data: tugua_srchook(src_url, data, runtime=runtime), validate=True, stats=metrics, compress=src_path.endswith(".gz"), runtime=runtime):
+		if runtime.prompt_on_failure:
+			input("Continue? ")
+		else:
+			record.fail(date_str, "page", url, "", "download failed")
+			assert os.path.isfile(src_path), "No source found!\n  Downloading '{}' failed, queued for retrying.".format(url)
+	metrics.url = url
+	metrics.lap("download")
+	data = read_source(src_path)
+	src = parse_html(data)
+	dest = BeautifulSoup("", get_html_parser())
+	metrics.lap("parse")
+	# analyze source title and frame
+	title_tag_src = src.find("title")
+	assert title_tag_src, "No title found!"
+	title = title_tag_src.get_text()
+	title_match = re.search(r"【喷嚏图卦(\d{8})】\S.*$", title)
+	assert title_match, "No title found!\n  Title tag is '{}'.".format(title)
+	assert date_str == title_match.group(1), "Date mismatch!\n  Input is '{}', actual is '{}'.".format(date_str, title_match.group(1))
+	title = title_match.group(0).strip()
+	# analyze and convert
+	(prologue, sections) = tugua_split(src, dest, base_url=url, runtime=runtime)
+	if runtime.download_img and not offline:
+		tugua_prewarm([prologue] + sections, get_imgcache(directory), runtime=runtime)
 	# debug
 	'''debug_output("0: {}".format(prologue))
 	count = 0
@@ -711,40 +2254,145 @@ def tugua_download(url, directory="", date=None, orig_url=None):
 			number_delta = number_count - curr_id
 		subtitle.replace_with(dest.new_string("【{:02}】{}".format(number_count, subtitle_match.group(2).strip())))
 	assert number_error <= config["CORRECTION"].getint("TitleNumErrorMax"), "Content Error!\n  Too many subtitle number mismatch, totally {} errors.".format(number_error)
+	metrics.count("sections", len(sections))
+	metrics.lap("analyze")
 	# prepare destination directory
 	dest_dir = os.path.join(directory, date_str)
+	unpacked = not os.path.isdir(dest_dir) and unpack_bundle(directory, date_str)
 	if not os.path.isdir(dest_dir):
 		os.makedirs(dest_dir)
-	os.chdir(dest_dir)
-	# load img_info from tmp file
-	tmp_path = os.path.join(src_dir, config["TUGUA"]["TmpFile"])
-	if os.path.isfile(tmp_path) and os.path.getsize(tmp_path) > 0:
-		with open(tmp_path, "rb") as tmp_file:
-			tmp_data = pickle.loads(tmp_file.read())
-	else:
-		tmp_data = {}
-	if date_str not in tmp_data:
-		tmp_data[date_str] = {}
-	img_info = tmp_data[date_str]
-	img_info["count"] = 0
-	# format sections & download images
-	try:
-		prologue = tugua_format(prologue, dest, img_info=img_info)
-		for index in range(len(sections)):
-			img_info["count"] = 0
-			section = tugua_format(sections[index], dest, img_info=img_info, section_id="{:02}".format(index+1), has_subtitle=True)
-			# remove ad
-			for tmp_p in list(section.children):
-				if re.match(config["SOURCECONF"]["RemoveParaRegex"], tmp_p.text.strip()):
-					tmp_p.extract()
-			#import shell
-			#shell.interact_loop(globals(), locals())
-			sections[index] = section
-	finally:
-		# store img_info into tmp file
-		with open(tmp_path, "wb") as tmp_file:
-			tmp_data[date_str] = img_info
-			tmp_file.write(pickle.dumps(tmp_data))
+	# load img_info from journal
+	manifest = record.manifest(date_str) if offline or not runtime.override_file else None
+	img_info = record.begin(date_str, clear_failures=not offline)
+	# move out inline images, download images & format sections
+	if config["TUGUA"]["InlineDir"]:
+		tugua_inline_images([prologue] + sections, directory, stats=metrics, runtime=runtime)
+	if runtime.download_img:
+		parts = [("", prologue)] + [("{:02}".format(index+1), sections[index]) for index in range(len(sections))]
+		local = tugua_local_images(dest_dir, parts, manifest) if offline else None
+		existing = {url: os.path.join(dest_dir, name) for (url, (name, _)) in manifest.items() if name and os.path.basename(name) == name} if manifest and not offline else None
+		failed = set(item[2] for item in record.failures() if item[0] == date_str and item[1] == "image") if offline else None
+		hook = lambda img_url, img_name, is_face: record.record(date_str, img_url, img_name, is_face)
+		fail_hook = None
+		if not runtime.prompt_on_failure:
+			fail_hook = lambda img_url, img_name, reason: record.fail(date_str, "image", img_url, img_name, reason)
+		tugua_images(parts, dest_dir, img_info, referer=url, img_cache=get_imgcache(directory), hook=hook, local=local, existing=existing, stats=metrics, transcoder=get_transcoder(), fail_hook=fail_hook, failed=failed, runtime=runtime)
+	metrics.lap("images")
+	prologue = tugua_format(prologue, dest, down_img=False, runtime=runtime)
+	for index in range(len(sections)):
+		sections[index] = tugua_format(sections[index], dest, section_id="{:02}".format(index+1), has_subtitle=True, down_img=False, runtime=runtime)
+	# keep the converted contents, and render the page from them
+	ir = ir_dump(title, orig_url or url, prologue, sections)
+	ir_dir = config["TUGUA"]["IRDir"]
+	if ir_dir:
+		ir_store(ir, os.path.join(directory, ir_dir, date_str + ".json"))
+	metrics.lap("format")
+	#dest_path = os.path.join(dest_dir, "{}.html".format(title))
+	dest_path = os.path.join(dest_dir, config["TUGUA"]["DestFile"])
+	sections = tugua_render(ir, dest_path, runtime=runtime)
+	metrics.lap("write")
+	# update search postings of this date
+	search = get_search(directory)
+	if search:
+		search.add(date_str, sections)
+	# mark finished in journal when complete
+	record.finish(date_str)
+	# pack the date again if it came from a bundle
+	if unpacked:
+		tugua_pack(directory, [date_str])
+	return
+
+def ir_dump(title, link, prologue, sections):
+	'''\
+	Dump converted page with [title:str], [link:str] to the original page, [prologue:bs4.element.Tag] and formatted [sections:list(bs4.element.Tag)] into the intermediate representation used by "tugua_render".
+	Nodes are dumped as [name, attrs, children] lists and strings, and class names from "IDENT" are replaced by "@" and their keys, so that they can be changed by rendering again.
+	Return: dict
+	'''
+	idents = {value: key for (key, value) in config["IDENT"].items()}
+	def dump(node):
+		if isinstance(node, NavigableString):
+			return str(node)
+		attrs = {}
+		for (key, value) in node.attrs.items():
+			if isinstance(value, list):
+				value = " ".join(value)
+			if key == "class" and value in idents:
+				value = "@" + idents[value]
+			attrs[key] = value
+		return [node.name, attrs, [dump(child) for child in node.contents]]
+	return {"version": ir_version, "title": title, "link": link, "prologue": dump(prologue), "sections": [dump(section) for section in sections]}
+
+def ir_store(ir, path):
+	'''\
+	Store intermediate representation [ir:dict] as compact JSON file [path:str].
+	Return: None
+	'''
+	if not os.path.isdir(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with open(path + ".tmp", "w", encoding="UTF-8") as ir_file:
+		json.dump(ir, ir_file, ensure_ascii=False, separators=(",", ":"))
+	os.replace(path + ".tmp", path)
+
+def ir_load(path):
+	'''\
+	Load intermediate representation stored in [path:str] by "ir_store".
+	Return: dict - None if it is stored by an incompatible version
+	'''
+	with open(path, "r", encoding="UTF-8") as ir_file:
+		ir = json.load(ir_file)
+	return ir if ir.get("version") == ir_version else None
+
+def ir_parse(ir, soup):
+	'''\
+	Load nodes of intermediate representation [ir:dict] back as tags of [soup:bs4.BeautifulSoup], with class names from "IDENT", so that they can be dumped again by "ir_dump".
+	Return: (bs4.element.Tag, list(bs4.element.Tag)) - prologue and sections
+	'''
+	def load(data):
+		if isinstance(data, str):
+			return soup.new_string(data)
+		(name, attrs, children) = data
+		attrs = {key: config["IDENT"][value[1:]] if key == "class" and value.startswith("@") else value for (key, value) in attrs.items()}
+		tag = soup.new_tag(name, attrs=attrs)
+		for child in children:
+			tag.append(load(child))
+		return tag
+	return (load(ir["prologue"]), [load(section) for section in ir["sections"]])
+
+def tugua_render(ir, dest_path, runtime=None):
+	'''\
+	Render page from intermediate representation [ir:dict] into file [dest_path:str], with "STYLE" files and "IDENT" names.
+	Ad paragraphs are removed here, and extra, ad and epilogue are separated from the last section.
+	Return: list(bs4.element.Tag) - sections rendered
+	'''
+	runtime = runtime or get_runtime()
+	epi_regex = runtime.epilogue_regex
+	dest = BeautifulSoup("", get_html_parser())
+	title = ir["title"]
+	(prologue, sections) = ir_parse(ir, dest)
+	# construct dest frame
+	dest.append(dest.new_tag("html"))
+	head_tag_dest = dest.new_tag("head")
+	charset_tag = dest.new_tag("meta")
+	charset_tag["http-equiv"] = "Content-Type"
+	charset_tag["content"] = "text/html; charset={}".format(config["TUGUA"]["DestEncoding"])
+	head_tag_dest.append(charset_tag)
+	if config["STYLE"]["JqueryFile"]:
+		head_tag_dest.append(dest.new_tag("script", type="text/javascript", src=config["STYLE"]["JqueryFile"]))
+	if config["STYLE"]["CssFile"]:
+		head_tag_dest.append(dest.new_tag("link", rel="stylesheet", type="text/css", href=config["STYLE"]["CssFile"]))
+	if config["STYLE"]["JsFile"]:
+		head_tag_dest.append(dest.new_tag("script", type="text/javascript", src=config["STYLE"]["JsFile"]))
+	title_tag_dest = dest.new_tag("title")
+	title_tag_dest.string = title
+	head_tag_dest.append(title_tag_dest)
+	dest.html.append(head_tag_dest)
+	body_tag_dest = dest.new_tag("body")
+	dest.html.append(body_tag_dest)
+	for section in sections:
+		# remove ad
+		for tmp_p in list(section.children):
+			if runtime.remove_para_regex.match(tmp_p.text.strip()):
+				tmp_p.extract()
 	# separate extra, ad and epilogue
 	tag = sections[-1]
 	temp = []
@@ -791,7 +2439,7 @@ def tugua_download(url, directory="", date=None, orig_url=None):
 	title_tag["class"] = config["IDENT"]["Title"]
 	title_tag.append(dest.new_tag("p"))
 	title_tag.p.append(dest.new_tag("a"))
-	title_tag.p.a["href"] = orig_url or url
+	title_tag.p.a["href"] = ir["link"]
 	title_tag.p.a.string = title
 	# regroup
 	body_tag_dest.append(title_tag)
@@ -801,79 +2449,665 @@ def tugua_download(url, directory="", date=None, orig_url=None):
 	body_tag_dest.append(extra_tag)
 	body_tag_dest.append(ad_tag)
 	body_tag_dest.append(epilogue_tag)
-	#dest_path = os.path.join(dest_dir, "{}.html".format(title))
-	dest_path = os.path.join(dest_dir, config["TUGUA"]["DestFile"])
-	with open(dest_path, "wb") as dest_file:
+	with open(dest_path, "w", encoding=config["TUGUA"]["DestEncoding"], newline="") as dest_file:
 		logger.info("Saving file '{}' ...".format(dest_path))
-		dest_file.write(dest.prettify().encode(config["TUGUA"]["DestEncoding"]))
-	# delete tmp record when complete
-	del tmp_data[date_str]
-	with open(tmp_path, "wb") as tmp_file:
-		tmp_file.write(pickle.dumps(tmp_data))
-	urlsrc = None
-	return
+		write_html(dest, dest_file, config["TUGUA"].getboolean("DestPrettify"))
+	return sections
 
-def catalogue_analyze(url, directory="", choice=None):
+def catalogue_fetch(url, directory="", runtime=None):
+	'''\
+	Download tugua catalogue page at [url:str] into [directory:str], with a conditional request if it was downloaded before.
+	Return: (str, bool, bool) - catalogue path, whether it is downloaded successfully, and whether it is modified
+	'''
+	runtime = runtime or get_runtime()
+	catalog_path = get_source_path(os.path.join(directory, config["TUGUA"]["CatalogFile"]))
+	def get_stat():
+		if not os.path.isfile(catalog_path):
+			return None
+		stat = os.stat(catalog_path)
+		return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+	stat = get_stat()
+	success = down_url(url, catalog_path, override=True, validate=True, compress=catalog_path.endswith(".gz"), runtime=runtime)
+	return (catalog_path, success, get_stat() != stat)
+
+def catalogue_pending(url, catalog_path, directory="", choice=None):
+	'''\
+	Find tugua listed in catalogue file [catalog_path:str] downloaded from [url:str], which are not converted into [directory:str] yet.
+	Only the date [choice:str] is considered if specified.
+	Return: list((str, str, str)) - title, url and date of each tugua
+	'''
+	catalog = parse_html(read_source(catalog_path))
+	pre_url = re.search(r"^(\S+/)[^/]*$", url).group(1)
+	title_regex = re.compile(r"^【喷嚏图卦(\d{8})】\S.*$")
+	min_date = config["TUGUA"]["MinDate"]
+	# list folders and bundles once instead of checking each date
+	names = set(os.listdir(directory))
+	bundle_dir = os.path.join(directory, config["TUGUA"]["BundleDir"]) if config["TUGUA"]["BundleDir"] else None
+	bundles = set(os.listdir(bundle_dir)) if bundle_dir and os.path.isdir(bundle_dir) else set()
+	pending = []
+	for item in catalog.find_all("a", href=True, text=title_regex):
+		href = item["href"]
+		title_match = title_regex.match(item.string)
+		if not href or not title_match:
+			continue
+		tugua_title = title_match.group(0).strip()
+		tugua_date = title_match.group(1)
+		if choice and choice != tugua_date:
+			continue
+		if min_date and min_date > tugua_date:
+			continue
+		tugua_dir = os.path.join(directory, tugua_date)
+		#tugua_index = os.path.join(tugua_dir, "{}.html".format(tugua_title))
+		tugua_index = os.path.join(tugua_dir, config["TUGUA"]["DestFile"])
+		if tugua_date + ".zip" in bundles:
+			continue
+		if tugua_date in names and os.path.isfile(tugua_index):
+			continue
+		pending.append((tugua_title, pre_url+href, tugua_date))
+	return pending
+
+def catalogue_download(title, url, date_str, directory="", runtime=None):
+	'''\
+	Download tugua [title:str] of [date_str:str] from [url:str] found in catalogue, and store into [directory:str].
+	Return: None
+	'''
+	runtime = runtime or get_runtime()
+	logger.info("Start Downloading tugua: {} ({}).".format(title, url))
+	tugua_download(url, directory=directory, date=date_str, runtime=runtime)
+
+def catalogue_analyze(url, directory="", choice=None, runtime=None):
 	'''\
 	Analyze tugua catalogue page at [url:str] and download all into [directory:str].
 	Return int - how many tugua downloaded
 	'''
+	runtime = runtime or get_runtime()
 	# prepare directory
 	directory = os.path.realpath(os.path.abspath(directory))
 	if not os.path.isdir(directory):
 		os.makedirs(directory)
-	catalog_path = os.path.join(directory, config["TUGUA"]["CatalogFile"])
-	if os.path.isfile(catalog_path):
-		os.remove(catalog_path)
 	# check existing source if choice is specified
 	if choice:
 		src_dir = os.path.join(directory, config["TUGUA"]["SrcDir"])
 		if not os.path.isdir(src_dir):
 			os.makedirs(src_dir)
-		src_path = os.path.join(src_dir, choice + ".html")
+		src_path = get_source_path(os.path.join(src_dir, choice + ".html"))
 		if os.path.isfile(src_path) and os.path.getsize(src_path) > 0:
-			tugua_download("", directory=directory, date=choice)
+			tugua_download("", directory=directory, date=choice, runtime=runtime)
 			return 1
 	# download catalogue
-	if not down_url(url, catalog_path):
+	(catalog_path, success, _) = catalogue_fetch(url, directory, runtime=runtime)
+	if not success and runtime.prompt_on_failure:
 		input("Continue? ")
-	with open(catalog_path, "rb") as catalog_file:
-		data = catalog_file.read()
-		catalog = parse_html(data)
 	# find tugua and start downloading
-	pre_url = re.search(r"^(\S+/)[^/]*$", url).group(1)
-	title_regex = re.compile(r"^【喷嚏图卦(\d{8})】\S.*$")
-	min_date = config["TUGUA"]["MinDate"]
+	pending = catalogue_pending(url, catalog_path, directory, choice)
+	# download sequentially, or several dates at once
+	date_threads = config["TUGUA"].getint("DateThreadCount")
+	if (date_threads <= 1 or len(pending) <= 1) and runtime.prompt_on_failure:
+		for item in pending:
+			catalogue_download(*item, directory=directory, runtime=runtime)
+		return len(pending)
+	# dates failed are logged and the others go on when several run at once or non-interactive
+	date_threads = max(date_threads, 1)
 	count = 0
-	for item in catalog.find_all("a", href=True, text=title_regex):
-		href = item["href"]
-		title_match = title_regex.match(item.string)
-		if not href or not title_match:
+	error = None
+	with ThreadPoolExecutor(max_workers=date_threads) as executor:
+		futures = [(item[2], executor.submit(catalogue_download, *item, directory=directory, runtime=runtime)) for item in pending]
+		for (tugua_date, future) in futures:
+			try:
+				future.result()
+				count += 1
+			except Exception as err:
+				logger.error("Download tugua {} failed.".format(tugua_date), exc_info=True)
+				error = error or err
+	if error and runtime.prompt_on_failure:
+		raise error
+	return count
+
+def tugua_watch(url, directory="", interval=None, runtime=None):
+	'''\
+	Watch tugua catalogue page at [url:str] and download new tugua into [directory:str] as soon as they are published, until interrupted or terminated.
+	The catalogue is polled every [interval:float] seconds ("WatchInterval" by default) with conditional requests, and only parsed again when modified.
+	Configuration, connections and caches stay loaded between polls, dates are converted in background by "DateThreadCount" threads, and the search index is merged after each of them.
+	Nothing is prompted, failures are queued as with "PromptOnFailure" off, and dates failed are tried again when the catalogue changes.
+	Status of polls and conversions is written to "WatchStatusFile" after each poll and conversion, as a JSON object.
+	Return: int - how many tugua downloaded
+	'''
+	runtime = (runtime or get_runtime())._replace(prompt_on_unsure=False, prompt_on_failure=False)
+	directory = os.path.realpath(os.path.abspath(directory))
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+	if interval is None:
+		interval = config["TUGUA"].getfloat("WatchInterval")
+	assert interval > 0, "Config Error!\n  Invalid watch interval '{}'.".format(interval)
+	status_path = os.path.join(directory, config["TUGUA"]["WatchStatusFile"]) if config["TUGUA"]["WatchStatusFile"] else None
+	status = {
+		"pid": os.getpid(),
+		"started": datetime.datetime.now().isoformat(timespec="seconds"),
+		"interval": interval,
+		"last_poll": None,
+		"poll_latency": None,
+		"last_modified": None,
+		"polls": 0,
+		"failed_polls": 0,
+		"queue": 0,
+		"converting": [],
+		"converted": 0,
+		"failed": 0,
+		"last_converted": None,
+		"last_failed": None,
+	}
+	def store_status():
+		if not status_path:
+			return
+		status["queue"] = sum(1 for future in futures.values() if not future.done())
+		status["converting"] = sorted(date_str for (date_str, future) in futures.items() if future.running())
+		tmp_path = "{}.{}.tmp".format(status_path, os.getpid())
+		with open(tmp_path, "w", encoding="UTF-8") as status_file:
+			json.dump(status, status_file, indent="\t")
+		os.replace(tmp_path, status_path)
+	# terminating is handled like interrupting, so that running conversions are finished and recorded
+	if threading.current_thread() is threading.main_thread():
+		signal.signal(signal.SIGTERM, signal.default_int_handler)
+	search = get_search(directory)
+	futures = {}
+	parsed = False
+	date_threads = max(config["TUGUA"].getint("DateThreadCount"), 1)
+	executor = ThreadPoolExecutor(max_workers=date_threads)
+	logger.info("Watching {} every {} seconds ...".format(url, interval))
+	try:
+		next_poll = time.monotonic()
+		while True:
+			# poll catalogue when due
+			if time.monotonic() >= next_poll:
+				next_poll = time.monotonic() + interval
+				start = time.perf_counter()
+				try:
+					(catalog_path, success, modified) = catalogue_fetch(url, directory, runtime=runtime)
+					if not success:
+						status["failed_polls"] += 1
+					if modified:
+						status["last_modified"] = datetime.datetime.now().isoformat(timespec="seconds")
+					if modified or not parsed:
+						# dates failed are not in [futures] any more, and are submitted again
+						for item in catalogue_pending(url, catalog_path, directory):
+							if item[2] not in futures:
+								logger.info("New tugua found: {}.".format(item[0]))
+								futures[item[2]] = executor.submit(catalogue_download, *item, directory=directory, runtime=runtime)
+						parsed = True
+				except Exception:
+					status["failed_polls"] += 1
+					logger.error("Poll catalogue {} failed.".format(url), exc_info=True)
+				status["polls"] += 1
+				status["last_poll"] = datetime.datetime.now().isoformat(timespec="seconds")
+				status["poll_latency"] = round(time.perf_counter() - start, 3)
+				store_status()
+			# collect conversions done
+			for (date_str, future) in list(futures.items()):
+				if not future.done():
+					continue
+				del futures[date_str]
+				try:
+					future.result()
+					status["converted"] += 1
+					status["last_converted"] = date_str
+					if search:
+						search.merge()
+				except Exception:
+					logger.error("Download tugua {} failed.".format(date_str), exc_info=True)
+					status["failed"] += 1
+					status["last_failed"] = date_str
+				store_status()
+			# wait for next poll, or a conversion done
+			timeout = max(next_poll - time.monotonic(), 0)
+			if futures:
+				wait(list(futures.values()), timeout=timeout, return_when=FIRST_COMPLETED)
+			else:
+				time.sleep(timeout)
+	except KeyboardInterrupt:
+		logger.info("Watching stopped, waiting for running conversions ...")
+	finally:
+		executor.shutdown(wait=True, cancel_futures=True)
+		for (date_str, future) in futures.items():
+			if future.cancelled():
+				continue
+			if future.exception():
+				logger.error("Download tugua {} failed.".format(date_str), exc_info=future.exception())
+				status["failed"] += 1
+				status["last_failed"] = date_str
+			else:
+				status["converted"] += 1
+				status["last_converted"] = date_str
+		futures.clear()
+		store_status()
+	return status["converted"]
+
+def tugua_rebuild(directory="", dates=None, runtime=None):
+	'''\
+	Convert stored sources of [dates:list(str)] under [directory:str] again without network, or all stored sources if [dates] is empty.
+	Dates are converted by a pool of "RebuildProcessCount" processes, one for each cpu if it is 0, and a summary of all dates is logged at the end.
+	Return: int - how many tugua rebuilt
+	'''
+	runtime = runtime or get_runtime()
+	directory = os.path.realpath(os.path.abspath(directory))
+	src_dir = os.path.join(directory, config["TUGUA"]["SrcDir"])
+	if not dates:
+		dates = sorted(set(name[:8] for name in os.listdir(src_dir) if re.match(r"^\d{8}\.html(\.gz)?$", name)))
+	processes = config["TUGUA"].getint("RebuildProcessCount") or os.cpu_count()
+	# open the journal once here, so that old records are imported before workers open it
+	get_journal(src_dir)
+	log_file = os.path.abspath(config["LOG"]["LogFile"]) if config["LOG"]["LogFile"] else ""
+	logger.info("Rebuilding {} tugua by {} processes ...".format(len(dates), processes))
+	summary = []
+	with ProcessPoolExecutor(max_workers=processes, initializer=init_worker, initargs=(config_path, log_file, logger.level)) as executor:
+		futures = [(date_str, executor.submit(tugua_download, "", directory, date_str, None, True, runtime=runtime)) for date_str in dates]
+		for (date_str, future) in futures:
+			try:
+				future.result()
+				summary.append((date_str, None))
+			except Exception as err:
+				summary.append((date_str, err))
+	count = 0
+	for (date_str, err) in summary:
+		if err is None:
+			count += 1
+			logger.info("Rebuild {}: OK".format(date_str))
+		else:
+			logger.error("Rebuild {}: FAILED, {}".format(date_str, repr(err)))
+	logger.info("Rebuild finished, {} succeeded, {} failed.".format(count, len(summary) - count))
+	return count
+
+
+def tugua_rerender(directory="", dates=None, runtime=None):
+	'''\
+	Render pages of [dates:list(str)] under [directory:str] again from intermediate representations stored in "IRDir", or all stored ones if [dates] is empty.
+	Nothing is parsed or downloaded, so it only applies changes of "STYLE", "IDENT" and ad, extra and epilogue separation.
+	Return: int - how many tugua rendered
+	'''
+	runtime = runtime or get_runtime()
+	directory = os.path.realpath(os.path.abspath(directory))
+	assert config["TUGUA"]["IRDir"], "Config Error!\n  IRDir is not set."
+	ir_dir = os.path.join(directory, config["TUGUA"]["IRDir"])
+	if not dates:
+		dates = sorted(name[:8] for name in os.listdir(ir_dir) if re.match(r"^\d{8}\.json$", name)) if os.path.isdir(ir_dir) else []
+	count = 0
+	for date_str in dates:
+		ir_path = os.path.join(ir_dir, date_str + ".json")
+		ir = ir_load(ir_path) if os.path.isfile(ir_path) else None
+		if not ir:
+			logger.warning("No usable intermediate representation of tugua {}, rebuild it instead.".format(date_str))
 			continue
-		tugua_title = title_match.group(0).strip()
-		tugua_date = title_match.group(1)
-		if choice and choice != tugua_date:
+		dest_dir = os.path.join(directory, date_str)
+		unpacked = not os.path.isdir(dest_dir) and unpack_bundle(directory, date_str)
+		if not os.path.isdir(dest_dir):
+			logger.warning("Tugua {} is not converted, skip rendering.".format(date_str))
 			continue
-		if min_date and min_date > tugua_date:
+		try:
+			tugua_render(ir, os.path.join(dest_dir, config["TUGUA"]["DestFile"]), runtime=runtime)
+			count += 1
+			if unpacked:
+				tugua_pack(directory, [date_str])
+		except AssertionError as err:
+			logger.error("Render tugua {} failed, {}".format(date_str, str(err)))
+	return count
+
+def tugua_retry(directory="", runtime=None):
+	'''\
+	Retry failures queued in the journal under [directory:str], without prompting.
+	Failed pages are downloaded and converted again, failed images are downloaded again and patched into converted pages of their dates, through the intermediate representation if stored.
+	Images found to be faces are named, classed and recorded like "tugua_images" does, and moved into the paragraph before them like "tugua_format" does.
+	Items failing again stay in the queue with tries counted.
+	Return: int - how many items fixed
+	'''
+	runtime = (runtime or get_runtime())._replace(prompt_on_unsure=False, prompt_on_failure=False)
+	directory = os.path.realpath(os.path.abspath(directory))
+	src_dir = os.path.join(directory, config["TUGUA"]["SrcDir"])
+	record = get_journal(src_dir)
+	img_cache = get_imgcache(directory)
+	failures = record.failures()
+	logger.info("Retrying {} failed items ...".format(len(failures)))
+	count = 0
+	images = {}
+	for (date_str, kind, url, name, reason, tries) in failures:
+		if kind == "page":
+			try:
+				tugua_download(url, directory=directory, date=date_str, runtime=runtime)
+				count += 1
+			except Exception as err:
+				logger.error("Retry tugua {} failed, {}".format(date_str, repr(err)))
+		else:
+			images.setdefault(date_str, []).append((url, name))
+	for (date_str, items) in sorted(images.items()):
+		date_dir = os.path.join(directory, date_str)
+		unpacked = not os.path.isdir(date_dir) and unpack_bundle(directory, date_str)
+		dest_path = os.path.join(date_dir, config["TUGUA"]["DestFile"])
+		if not os.path.isfile(dest_path):
+			logger.warning("Tugua {} is not converted, skip retrying its images.".format(date_str))
 			continue
-		tugua_dir = os.path.join(directory, tugua_date)
-		#tugua_index = os.path.join(tugua_dir, "{}.html".format(tugua_title))
-		tugua_index = os.path.join(tugua_dir, config["TUGUA"]["DestFile"])
-		if os.path.isdir(tugua_dir) and os.path.isfile(tugua_index):
+		referer = record.urls(date_str)[0] or load_validator(get_source_path(os.path.join(src_dir, date_str + ".html"))).get("url")
+		# patch the intermediate representation and render it if stored, or patch the page itself
+		ir_path = os.path.join(directory, config["TUGUA"]["IRDir"], date_str + ".json") if config["TUGUA"]["IRDir"] else None
+		ir = ir_load(ir_path) if ir_path and os.path.isfile(ir_path) else None
+		if ir:
+			dest = BeautifulSoup("", get_html_parser())
+			(prologue, sections) = ir_parse(ir, dest)
+			img_tags = [tag for node in [prologue] + sections for tag in node.find_all("img")]
+		else:
+			with open(dest_path, "rb") as dest_file:
+				dest = parse_html(dest_file.read())
+			img_tags = dest.find_all("img")
+		faces = set(name for (name, is_face) in record.manifest(date_str).values() if is_face)
+		def is_inline(node):
+			return node is not None and node.name == "p" and not node.get("class") and all(runtime.face_ident in img.get("class", []) for img in node.find_all("img"))
+		def join_para(tag):
+			# the placeholder broke its paragraph like other images, while a face stays inline with text around it
+			para = tag.parent
+			if para.name != "p" or [child for child in para.contents if not isinstance(child, NavigableString) or child.strip()] != [tag]:
+				return
+			(prev_para, next_para) = (para.find_previous_sibling(), para.find_next_sibling())
+			if is_inline(next_para):
+				for child in list(next_para.contents):
+					para.append(child.extract())
+				next_para.decompose()
+			if is_inline(prev_para):
+				for child in list(para.contents):
+					prev_para.append(child.extract())
+				para.decompose()
+		patched = 0
+		for (url, name) in items:
+			result = down_img(url, date_dir, referer=referer, runtime=runtime)
+			if not result or not result[0].size:
+				if result:
+					os.remove(result[1])
+				record.fail(date_str, "image", url, name, "unrecognized" if result else "download failed")
+				continue
+			(sniffer, tmp_path) = result
+			is_face = bool(sniffer.format) and sniffer.is_face(runtime)
+			if is_face:
+				new_name = "{}_{:02}.{}".format(runtime.face_ident, len(faces)+1, sniffer.format)
+				faces.add(new_name)
+			else:
+				new_name = "{}.{}".format(os.path.splitext(name)[0], sniffer.format) if sniffer.format else name
+			img_path = os.path.join(date_dir, new_name)
+			if img_cache and not url.startswith("data:"):
+				img_cache.save_file(url, tmp_path, img_path)
+			else:
+				os.replace(tmp_path, img_path)
+			record.record(date_str, url, new_name, is_face)
+			for tag in img_tags:
+				if tag.get("data-src", "").strip() != url and tag.get("src") != name:
+					continue
+				tag["src"] = new_name
+				if tag.get("data-src") is not None:
+					del tag["data-src"]
+				if runtime.failed_ident in tag.get("class", []):
+					del tag["class"]
+				if is_face:
+					tag["class"] = runtime.face_ident
+					join_para(tag)
+			record.resolve(date_str, "image", url)
+			logger.info("Image '{}' of tugua {} fixed as '{}'.".format(url, date_str, new_name))
+			patched += 1
+		if patched and ir:
+			ir = ir_dump(ir["title"], ir["link"], prologue, sections)
+			ir_store(ir, ir_path)
+			tugua_render(ir, dest_path, runtime=runtime)
+		elif patched:
+			with open(dest_path, "w", encoding=config["TUGUA"]["DestEncoding"], newline="") as dest_file:
+				logger.info("Saving file '{}' ...".format(dest_path))
+				write_html(dest, dest_file, config["TUGUA"].getboolean("DestPrettify"))
+		if unpacked:
+			tugua_pack(directory, [date_str])
+		count += patched
+	return count
+
+def tugua_compress(directory=""):
+	'''\
+	Compress source pages and the catalogue under [directory:str] stored before "SrcCompress", moving their validators along.
+	A page already compressed and newer than the raw one only has the raw one removed.
+	Return: int - how many files compressed
+	'''
+	directory = os.path.realpath(os.path.abspath(directory))
+	src_dir = os.path.join(directory, config["TUGUA"]["SrcDir"])
+	paths = []
+	if os.path.isdir(src_dir):
+		paths = [os.path.join(src_dir, name) for name in sorted(os.listdir(src_dir)) if re.match(r"^\d{8}\.html$", name)]
+	if os.path.isfile(os.path.join(directory, config["TUGUA"]["CatalogFile"])):
+		paths.append(os.path.join(directory, config["TUGUA"]["CatalogFile"]))
+	(count, raw_size, gz_size) = (0, 0, 0)
+	for path in paths:
+		gz_path = path + ".gz"
+		if os.path.isfile(gz_path) and os.path.getmtime(gz_path) >= os.path.getmtime(path):
+			logger.warning("Source '{}' is compressed already, remove the raw one.".format(path))
+		else:
+			with open(path, "rb") as src_file:
+				data = src_file.read()
+			with open(gz_path + ".tmp", "wb") as gz_file:
+				gz_file.write(gzip.compress(data, mtime=0))
+			os.replace(gz_path + ".tmp", gz_path)
+			if os.path.isfile(path + ".validator"):
+				os.replace(path + ".validator", gz_path + ".validator")
+			count += 1
+			raw_size += len(data)
+			gz_size += os.path.getsize(gz_path)
+		os.remove(path)
+		if os.path.isfile(path + ".validator"):
+			os.remove(path + ".validator")
+	logger.info("Compressed {} sources from {} KB to {} KB.".format(count, raw_size // 1024, gz_size // 1024))
+	return count
+
+def get_bundle_path(directory, date_str):
+	'''\
+	Get the bundle file of [date_str:str] under tugua [directory:str], configured by "BundleDir".
+	Return: str - None if bundles are disabled
+	'''
+	if not config["TUGUA"]["BundleDir"]:
+		return None
+	return os.path.join(directory, config["TUGUA"]["BundleDir"], date_str + ".zip")
+
+class Bundle(object):
+	'''\
+	Reader of a bundle, a zip file of one converted date with members stored uncompressed.
+	Member offsets are taken from the zip central directory once, and members are read by offset from a memory map.
+	'''
+	def __init__(self, path):
+		self.path = path
+		self.members = {}
+		with open(path, "rb") as bundle_file:
+			self.mmap = mmap.mmap(bundle_file.fileno(), 0, access=mmap.ACCESS_READ)
+		with zipfile.ZipFile(path) as bundle:
+			for info in bundle.infolist():
+				assert info.compress_type == zipfile.ZIP_STORED, "Bundle Error!\n  Member '{}' of '{}' is compressed.".format(info.filename, path)
+				# local header is 30 bytes, with lengths of name and extra field at 26
+				(name_len, extra_len) = struct.unpack("<HH", self.mmap[info.header_offset+26:info.header_offset+30])
+				self.members[info.filename] = (info.header_offset + 30 + name_len + extra_len, info.file_size)
+	
+	def read(self, name):
+		'''\
+		Read member [name:str].
+		Return: bytes - None if not found
+		'''
+		if name not in self.members:
+			return None
+		(offset, size) = self.members[name]
+		return self.mmap[offset:offset+size]
+	
+	def close(self):
+		self.mmap.close()
+
+def unpack_bundle(directory, date_str):
+	'''\
+	Extract the bundle of [date_str:str] under tugua [directory:str] back into its date folder, so that it can be converted again.
+	The bundle is removed once extracted, so that the date is never kept twice, and it should be packed again by the caller when done.
+	Return: bool - whether a bundle is found
+	'''
+	path = get_bundle_path(directory, date_str)
+	if not path or not os.path.isfile(path):
+		return False
+	logger.info("Unpacking bundle '{}' ...".format(path))
+	with zipfile.ZipFile(path) as bundle:
+		bundle.extractall(os.path.join(directory, date_str))
+	os.remove(path)
+	return True
+
+def tugua_pack(directory="", dates=None):
+	'''\
+	Pack converted folders of [dates:list(str)] under [directory:str] into bundles, or all completed dates if [dates] is empty.
+	Dates unfinished in the journal or without the converted page are skipped, and a folder is removed only after its bundle is verified.
+	Hidden and temporary files are not packed.
+	Return: int - how many tugua packed
+	'''
+	directory = os.path.realpath(os.path.abspath(directory))
+	assert config["TUGUA"]["BundleDir"], "Config Error!\n  BundleDir is not set."
+	bundle_dir = os.path.join(directory, config["TUGUA"]["BundleDir"])
+	if not os.path.isdir(bundle_dir):
+		os.makedirs(bundle_dir)
+	if not dates:
+		dates = sorted(name for name in os.listdir(directory) if re.match(r"^\d{8}$", name) and os.path.isdir(os.path.join(directory, name)))
+	unfinished = get_journal(os.path.join(directory, config["TUGUA"]["SrcDir"])).unfinished()
+	count = 0
+	for date_str in dates:
+		date_dir = os.path.join(directory, date_str)
+		if date_str in unfinished or not os.path.isfile(os.path.join(date_dir, config["TUGUA"]["DestFile"])):
+			logger.warning("Tugua {} is not completed, skip packing.".format(date_str))
 			continue
-		tugua_url = pre_url+href
-		logger.info("Start Downloading tugua: {} ({}).".format(tugua_title, tugua_url))
-		tugua_download(tugua_url, directory=directory, date=tugua_date)
+		path = get_bundle_path(directory, date_str)
+		tmp_path = path + ".tmp"
+		# leave out temporary files of interrupted downloads and writes
+		names = sorted(name for name in os.listdir(date_dir) if os.path.isfile(os.path.join(date_dir, name)) and not name.startswith(".") and not name.endswith((".tmp", ".part", ".download")))
+		with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_STORED) as bundle:
+			for name in names:
+				bundle.write(os.path.join(date_dir, name), name)
+		with zipfile.ZipFile(tmp_path) as bundle:
+			bad_name = bundle.testzip()
+		assert bad_name is None, "Bundle Error!\n  Member '{}' of '{}' is broken.".format(bad_name, tmp_path)
+		os.replace(tmp_path, path)
+		shutil.rmtree(date_dir)
+		logger.info("Packed tugua {} into '{}', {} files.".format(date_str, path, len(names)))
 		count += 1
 	return count
 
+def tugua_serve(directory="", port=8000):
+	'''\
+	Serve tugua [directory:str] over HTTP on localhost [port:int] until interrupted.
+	"/YYYYmmdd/[name]" is served from the bundle of that date if its folder does not exist, and everything else from files.
+	Return: None
+	'''
+	directory = os.path.realpath(os.path.abspath(directory))
+	bundles = {}
+	lock = threading.Lock()
+	def get_bundle(date_str):
+		path = get_bundle_path(directory, date_str)
+		if not path or not os.path.isfile(path):
+			return None
+		key = (path, os.path.getmtime(path))
+		with lock:
+			if key not in bundles:
+				bundles[key] = Bundle(path)
+			return bundles[key]
+	
+	class Handler(http.server.SimpleHTTPRequestHandler):
+		def __init__(self, *args, **kwargs):
+			super().__init__(*args, directory=directory, **kwargs)
+		
+		def send_head(self):
+			path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+			path_match = re.match(r"^/(\d{8})(/([^/]*))?$", path)
+			bundle = None
+			if path_match and not os.path.isdir(os.path.join(directory, path_match.group(1))):
+				bundle = get_bundle(path_match.group(1))
+			if not bundle:
+				return super().send_head()
+			if path_match.group(2) is None:
+				self.send_response(301)
+				self.send_header("Location", path + "/")
+				self.send_header("Content-Length", "0")
+				self.end_headers()
+				return None
+			name = path_match.group(3) or config["TUGUA"]["DestFile"]
+			data = bundle.read(name)
+			if data is None:
+				self.send_error(404, "File not found")
+				return None
+			self.send_response(200)
+			self.send_header("Content-Type", mimetypes.guess_type(name)[0] or "application/octet-stream")
+			self.send_header("Content-Length", str(len(data)))
+			self.end_headers()
+			return io.BytesIO(data)
+		
+		def log_message(self, format, *args):
+			logger.debug("Serve: " + format % args)
+	
+	server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+	logger.info("Serving '{}' at http://127.0.0.1:{}/ ...".format(directory, server.server_address[1]))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		for bundle in bundles.values():
+			bundle.close()
+
+
+def init_config(path):
+	'''\
+	Load configuration file [path:str] into the global config.
+	Return: configparser.ConfigParser
+	'''
+	global config
+	global config_path
+	global runtime
+	global htmlparser
+	config = ConfigParser()
+	config.read(path, encoding="UTF-8")
+	config_path = os.path.abspath(path)
+	runtime = load_runtime(config)
+	htmlparser = None
+	return config
+
+def init_logger(log_file="", level=logging.NOTSET):
+	'''\
+	Set up the global logger printing to stdout, and also to [log_file:str] if specified.
+	Return: logging.Logger
+	'''
+	global logger
+	logger = logging.getLogger()
+	logger.setLevel(level)
+	formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+	handler = logging.StreamHandler(sys.stdout)
+	handler.setFormatter(formatter)
+	handler.setLevel(level)
+	logger.addHandler(handler)
+	if log_file:
+		handler = logging.FileHandler(log_file)
+		handler.setFormatter(formatter)
+		handler.setLevel(level)
+		logger.addHandler(handler)
+	return logger
+
+def init_worker(config_path, log_file="", level=logging.NOTSET):
+	'''\
+	Initialize a worker process with configuration file [config_path:str] and logger like "init_logger".
+	Connections, caches and journal inherited from the parent process are dropped, so that they are opened again in this process.
+	Return: None
+	'''
+	global connpool
+	global downlimit
+	global hostlimit
+	global imgcache
+	global transcoder
+	global journal
+	(connpool, downlimit, hostlimit, imgcache, transcoder, journal) = (None, None, None, None, None, None)
+	logging.getLogger().handlers.clear()
+	init_config(config_path)
+	init_logger(log_file, level)
+
 
 if __name__ == "__main__":
 	# configuration
-	config = ConfigParser()
 	cwd = get_py_path()
 	os.chdir(cwd)
-	config.read("tugua.cfg", encoding="UTF-8")
+	init_config("tugua.cfg")
 	# prepare folder
 	directory=config["TUGUA"]["TuguaDir"]
 	if not os.path.isdir(directory):
@@ -883,21 +3117,18 @@ if __name__ == "__main__":
 	if config["NETWORK"]["DownloadProxy"]:
 		os.environ["http_proxy"] = config["NETWORK"]["DownloadProxy"]
 	# set logger
-	logger = logging.getLogger()
-	logger.setLevel(logging.NOTSET)
-	formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-	handler = logging.StreamHandler(sys.stdout)
-	handler.setFormatter(formatter)
-	handler.setLevel(logging.NOTSET)
-	logger.addHandler(handler)
-	if config["LOG"]["LogFile"]:
-		handler = logging.FileHandler(config["LOG"]["LogFile"])
-		handler.setFormatter(formatter)
-		handler.setLevel(logging.NOTSET)
-		logger.addHandler(handler)
+	init_logger(config["LOG"]["LogFile"])
 	# check arguments
-	if len(sys.argv) > 4:
+	command = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] in ("rebuild", "render", "pack", "serve", "watch", "compress", "retry") else None
+	if (len(sys.argv) > 4 and not command) or (command in ("serve", "watch") and len(sys.argv) > 3) or (command in ("compress", "retry") and len(sys.argv) > 2):
 		logger.fatal("Usage: {} [date_string] [url_string] [orig_url_string]".format(sys.argv[0]))
+		logger.fatal("       {} rebuild [date_string ...]".format(sys.argv[0]))
+		logger.fatal("       {} render [date_string ...]".format(sys.argv[0]))
+		logger.fatal("       {} pack [date_string ...]".format(sys.argv[0]))
+		logger.fatal("       {} serve [port]".format(sys.argv[0]))
+		logger.fatal("       {} watch [interval_seconds]".format(sys.argv[0]))
+		logger.fatal("       {} compress".format(sys.argv[0]))
+		logger.fatal("       {} retry".format(sys.argv[0]))
 		exit(1)
 	date = None
 	url = None
@@ -912,13 +3143,42 @@ if __name__ == "__main__":
 		date = sys.argv[1]
 	# downloading
 	try:
-		if date and url:
-			tugua_download(url, date=date, orig_url=orig_url)
-			count = 1
+		if command == "serve":
+			tugua_serve(port=int(sys.argv[2]) if len(sys.argv) > 2 else 8000)
+		elif command == "watch":
+			count = tugua_watch(config["TUGUA"]["CatalogURL"], interval=float(sys.argv[2]) if len(sys.argv) > 2 else None, runtime=runtime)
+			logger.info("Totally {} tugua downloaded.".format(count))
+		elif command == "retry":
+			count = tugua_retry(runtime=runtime)
+			logger.info("Totally {} failed items fixed.".format(count))
+		elif command == "compress":
+			tugua_compress()
+		elif command == "pack":
+			count = tugua_pack(dates=sys.argv[2:])
+			logger.info("Totally {} tugua packed.".format(count))
+		elif command == "render":
+			count = tugua_rerender(dates=sys.argv[2:], runtime=runtime)
+			logger.info("Totally {} tugua rendered.".format(count))
+		elif command == "rebuild":
+			count = tugua_rebuild(dates=sys.argv[2:], runtime=runtime)
+			logger.info("Totally {} tugua rebuilt.".format(count))
+		elif date and url:
+			tugua_download(url, date=date, orig_url=orig_url, runtime=runtime)
+			logger.info("Totally 1 tugua downloaded.")
 		else:
-			count = catalogue_analyze(config["TUGUA"]["CatalogURL"], choice=date)
-		logger.info("Totally {} tugua downloaded.".format(count))
+			count = catalogue_analyze(config["TUGUA"]["CatalogURL"], choice=date, runtime=runtime)
+			logger.info("Totally {} tugua downloaded.".format(count))
+	except:
+		logger.critical("!!! Exception occurred !!!", exc_info=True)
+	# merge search postings of converted dates
+	try:
+		search = get_search("")
+		if search:
+			search.merge()
 	except:
 		logger.critical("!!! Exception occurred !!!", exc_info=True)
+	close_connpool()
+	close_transcoder()
+	close_journal()
 	logger.info("--------------------------------")
 	
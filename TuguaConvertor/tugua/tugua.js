@@ -2,6 +2,10 @@ var show_str = "显示目录";
 var hide_str = "隐藏目录";
 var prev_str = "上一页";
 var next_str = "下一页";
+var search_str = "搜索";
+var search_none_str = "没有找到";
+var search_dir = "../search/";
+var search_limit = 200;
 
 String.prototype.trim=function(){
 	return this.replace(/(^\s*)|(\s*$)/g, "");
@@ -94,11 +98,150 @@ function insertQuickNav() {
 	$("body").append($html);
 };
 
+var searchData = {};
+var searchCallbacks = {};
+
+function tuguaSearchLoad(name, data) {
+	searchData[name] = data;
+	var callbacks = searchCallbacks[name] || [];
+	delete searchCallbacks[name];
+	for (var i = 0; i < callbacks.length; i++)
+		callbacks[i](data);
+};
+
+function loadSearchData(name, callback) {
+	// shards are loaded by script tags calling tuguaSearchLoad, which also works for pages opened from local disk
+	if (name in searchData) {
+		callback(searchData[name]);
+		return;
+	}
+	if (name in searchCallbacks) {
+		searchCallbacks[name].push(callback);
+		return;
+	}
+	searchCallbacks[name] = [callback];
+	var script = document.createElement("script");
+	script.src = search_dir + name + ".js";
+	script.onerror = function() {
+		tuguaSearchLoad(name, {});
+	};
+	document.body.appendChild(script);
+};
+
+function searchTokens(text) {
+	// the same as SearchIndex.tokens in tugua.py
+	var tokens = [];
+	var words = text.toLowerCase().match(/[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[0-9a-z]+/g) || [];
+	for (var i = 0; i < words.length; i++) {
+		var word = words[i];
+		if (word.charCodeAt(0) < 0x80) {
+			if (word.length > 1 && $.inArray(word, tokens) < 0)
+				tokens.push(word);
+		} else {
+			for (var j = 0; j + 1 < word.length; j++) {
+				if ($.inArray(word.substr(j, 2), tokens) < 0)
+					tokens.push(word.substr(j, 2));
+			}
+		}
+	}
+	return tokens;
+};
+
+function searchHash(token) {
+	// the same as SearchIndex.token_hash in tugua.py
+	var value = 0;
+	for (var i = 0; i < token.length; i++)
+		value = (value * 31 + token.charCodeAt(i)) >>> 0;
+	return value;
+};
+
+function searchTugua(query, callback) {
+	// callback gets sections containing all tokens of query, latest first, as [{date, id, subtitle}]
+	var tokens = searchTokens(query);
+	if (!tokens.length) {
+		callback([]);
+		return;
+	}
+	loadSearchData("meta", function(meta) {
+		if (!meta.shards) {
+			callback([]);
+			return;
+		}
+		var lists = [];
+		$.each(tokens, function(index, token) {
+			var shard = ("0" + (searchHash(token) % meta.shards).toString(16)).substr(-2);
+			loadSearchData("index/" + shard, function(data) {
+				lists.push(data[token] || []);
+				if (lists.length < tokens.length)
+					return;
+				lists.sort(function(a, b) { return a.length - b.length; });
+				var docs = $.grep(lists[0], function(doc) {
+					for (var i = 1; i < lists.length; i++) {
+						if ($.inArray(doc, lists[i]) < 0)
+							return false;
+					}
+					return true;
+				});
+				docs.sort(function(a, b) { return b - a; });
+				docs = docs.slice(0, search_limit);
+				var months = [];
+				$.each(docs, function(index, doc) {
+					var month = String(doc).substr(0, 6);
+					if ($.inArray(month, months) < 0)
+						months.push(month);
+				});
+				var loaded = 0;
+				var finish = function() {
+					callback($.map(docs, function(doc) {
+						var key = String(doc);
+						var subtitles = searchData["docs/" + key.substr(0, 6)] || {};
+						return {date: key.substr(0, 8), id: key.substr(8), subtitle: subtitles[key] || ""};
+					}));
+				};
+				if (!months.length)
+					finish();
+				$.each(months, function(index, month) {
+					loadSearchData("docs/" + month, function() {
+						if (++loaded == months.length)
+							finish();
+					});
+				});
+			});
+		});
+	});
+};
+
+function insertSearch() {
+	var $input = $("<input>").attr("type", "text").attr("id", "search_input");
+	var $button = $("<a>").attr("href", "javascript:void(0)").text(search_str);
+	var $result = $("<ul>").attr("id", "search_result");
+	var date = $("title").text().match(/\d{8}/)[0];
+	var path = window.location.href.split("#")[0];
+	var search = function() {
+		searchTugua($input.val(), function(results) {
+			$result.empty();
+			if (!results.length)
+				$result.append($("<li>").text(search_none_str));
+			$.each(results, function(index, result) {
+				var href = path.replace(date, result.date) + "#" + result.id;
+				$result.append($("<li>").append($("<a>").attr("href", href).text(result.date + " " + result.subtitle)));
+			});
+		});
+	};
+	$button.click(search);
+	$input.keydown(function(event) {
+		if (event.which == 13)
+			search();
+	});
+	$("#title").after($("<div>").addClass("search").append($input, $button, $result));
+};
+
 $(document).ready(function() {
 	insertCatalogue();
 	showCatalogue();
 	insertEmbedFrame();
 	insertQuickNav();
+	insertSearch();
 	
 	// return to top function
 	$(document.body).append("<a href=\"#0\" class=\"cd-top\">Top</a>");